@@ -0,0 +1,33 @@
+"""
+Records the live wikipedia list and mediathekview response as fixtures (replacing the synthetic ones).
+Live fixtures are not labelled, so the matching accuracy is only reported for the synthetic fixtures.
+"""
+import gzip
+import json
+
+import click
+import requests
+
+from synthetic import FIXTURES
+
+
+@click.command()
+@click.option('--query-size', default=1000, help='Number of mediathekview results')
+def main(query_size):
+    FIXTURES.mkdir(parents=True, exist_ok=True)
+    html = requests.get('https://de.wikipedia.org/wiki/Liste_der_Tatort-Folgen').text
+    with gzip.open(FIXTURES / 'tatort_list.html.gz', 'wt') as f:
+        f.write(html)
+
+    res = requests.post('https://mediathekviewweb.de/api/query',
+                        headers={'Content-Type': 'text/plain'},
+                        data=json.dumps({"queries": [{"fields": ["topic", "title"], "query": "tatort"}],
+                                         "sortBy": "timestamp", "sortOrder": "desc", "offset": 0, 'future': True,
+                                         "size": query_size, 'duration_min': 55 * 60, 'duration_max': 105 * 60}))
+    with gzip.open(FIXTURES / 'mediathek.json.gz', 'wt') as f:
+        json.dump(res.json(), f)
+    (FIXTURES / 'labels.json').unlink(missing_ok=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+"""
+Offline benchmark of the mediathek and wikipedia pipelines and the matching.
+
+    python benchmarks/run.py                      # compare against benchmarks/baseline.json
+    python benchmarks/run.py --update-baseline    # store the current timings as new baseline
+
+Timings depend on the machine, the baseline should therefore be recorded on the machine that runs the comparison.
+"""
+import gc
+import gzip
+import json
+import logging
+import subprocess
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import click
+import pandas as pd
+
+# the benchmarks run from the checkout, the package doesn't have to be installed
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from synthetic import FIXTURES, scale_html, scale_results
+from tripper.data_model import MediathekWrapper, TableStore, WikipediaWrapper
+from tripper.util.stream import iter_json_array
+
+BASELINE = Path(__file__).parent / 'baseline.json'
+THRESHOLDS = dict(title_thresh=90, desc_thresh=10)
+
+
+def measure(fn, repeat):
+    """
+    :return: best wall time, peak traced memory in MB and the result of fn
+    """
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    gc.collect()
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1] / 2 ** 20
+    tracemalloc.stop()
+    return min(times), peak, result
+
+
+def startup(repeat):
+    """
+    :return: best wall time of a fresh interpreter importing the cli, the slowest imports of the last run
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        out = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import tripper.cli'],
+                             capture_output=True, text=True, check=True, cwd=Path(__file__).parent.parent)
+        times.append(time.perf_counter() - start)
+    imports = [line.split('|') for line in out.stderr.splitlines() if line.startswith('import time:')][1:]
+    slowest = sorted(((int(cumulative), module.strip()) for _, cumulative, module in imports), reverse=True)
+    return min(times), slowest[:5]
+
+
+def parse_mediathek(payload: bytes) -> pd.DataFrame:
+    # the response is streamed in chunks of the same size as in MediathekWrapper._query
+    chunks = (payload[i:i + (1 << 16)] for i in range(0, len(payload), 1 << 16))
+    return MediathekWrapper._process(iter_json_array(chunks, 'results'))
+
+
+def wrapper(episodes: pd.DataFrame, cache_dir: str, workers: int) -> WikipediaWrapper:
+    TableStore(Path(cache_dir) / 'episodes', version=WikipediaWrapper.CACHE_VERSION, fallback='pickle',
+               set_columns=['meta_data']).write(episodes)
+    return WikipediaWrapper(cache_dir, [], THRESHOLDS, offline=True, matching=dict(workers=workers))
+
+
+def accuracy(predictions: pd.Series, labels: dict) -> float:
+    correct = [ids == ([labels[index]] if labels[index] is not None else []) or
+               (labels[index] is None and len(ids) != 1)
+               for index, ids in predictions.items()]
+    return sum(correct) / len(correct)
+
+
+@click.command()
+@click.option('--scale', default=10, help='Factor of the scaled-up variant')
+@click.option('--repeat', default=3, help='Repetitions per stage, the best time is reported')
+@click.option('--tolerance', default=.5, help='Allowed relative slowdown compared to the baseline')
+@click.option('--workers', default=1, help='Processes of the fuzzy matching in match_batch')
+@click.option('--baseline', default=str(BASELINE), help='Baseline file')
+@click.option('--update-baseline', is_flag=True, help='Store the results as new baseline')
+def main(scale, repeat, tolerance, workers, baseline, update_baseline):
+    logging.basicConfig(level=logging.WARNING)
+    with gzip.open(FIXTURES / 'mediathek.json.gz', 'rt') as f:
+        payload = json.load(f)
+    with gzip.open(FIXTURES / 'tatort_list.html.gz', 'rt') as f:
+        html = f.read()
+    labels_path = FIXTURES / 'labels.json'
+    labels = json.loads(labels_path.read_text()) if labels_path.exists() else None
+    episodes = WikipediaWrapper._parse_wiki_tatortlist(html)
+
+    payloads = {1: json.dumps(payload).encode(),
+                scale: json.dumps(dict(result=dict(results=scale_results(payload['result']['results'],
+                                                                         scale)))).encode()}
+    htmls = {1: html, scale: scale_html(episodes, scale)}
+
+    results = dict()
+    seconds, slowest = startup(repeat)
+    results['cli_startup'] = dict(seconds=seconds, rows=1, rows_per_second=1 / seconds, peak_mb=0)
+
+    with TemporaryDirectory() as cache_dir:
+        model = wrapper(episodes, cache_dir, workers)
+        for factor in sorted({1, scale}):
+            suffix = '' if factor == 1 else f'_x{factor}'
+            stages = dict(
+                mediathek_parse=lambda: parse_mediathek(payloads[factor]),
+                wiki_parse=lambda: WikipediaWrapper._parse_wiki_tatortlist(htmls[factor]),
+            )
+            mediathek = parse_mediathek(payloads[factor])
+            if factor == 1:
+                stages['index_build'] = lambda: type(model.index)(model.episodes)
+                stages['match_single'] = lambda: pd.Series(
+                    [model.try_predict_id(title, descr) for title, descr in zip(mediathek.title,
+                                                                                mediathek.description)],
+                    index=mediathek.index)
+            stages['match_batch'] = lambda: model.predict_ids(mediathek)
+
+            for name, fn in stages.items():
+                seconds, peak, result = measure(fn, repeat)
+                rows = len(mediathek) if name.startswith('match') else len(result)
+                results[name + suffix] = dict(seconds=seconds, rows=rows, rows_per_second=rows / seconds,
+                                              peak_mb=peak)
+                if name.startswith('match') and labels is not None:
+                    results[name + suffix]['accuracy'] = accuracy(
+                        result, {index: labels[index.rsplit('-', 1)[0] if factor != 1 else index]
+                                 for index in result.index})
+
+    print(f'{"stage":<24}{"seconds":>10}{"rows/s":>12}{"peak MB":>10}{"accuracy":>10}')
+    for name, r in results.items():
+        acc = f'{r["accuracy"]:.3f}' if 'accuracy' in r else ''
+        print(f'{name:<24}{r["seconds"]:>10.3f}{r["rows_per_second"]:>12.0f}{r["peak_mb"]:>10.1f}{acc:>10}')
+    print('slowest imports of the cli: ' + ', '.join(f'{module} {us / 1000:.0f}ms' for us, module in slowest))
+
+    if update_baseline:
+        Path(baseline).write_text(json.dumps(results, indent=2))
+        return
+    if not Path(baseline).exists():
+        print(f'No baseline found at {baseline}')
+        return
+
+    reference = json.loads(Path(baseline).read_text())
+    regressions = []
+    for name, r in results.items():
+        if name not in reference:
+            continue
+        if r['seconds'] > reference[name]['seconds'] * (1 + tolerance):
+            regressions.append(f'{name}: {r["seconds"]:.3f}s (baseline {reference[name]["seconds"]:.3f}s)')
+        if r.get('accuracy', 1) < reference[name].get('accuracy', 0) - 1e-3:
+            regressions.append(f'{name}: accuracy {r["accuracy"]:.3f} (baseline {reference[name]["accuracy"]:.3f})')
+    if regressions:
+        print('Performance regressions:\n  ' + '\n  '.join(regressions))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+"""
+Generates synthetic fixtures that mimic the wikipedia list of tatort episodes and the mediathekview response.
+
+The mediathek entries are derived from the episodes (with the typical title variations, typos and
+entries that have to be filtered), hence the correct tatort id of every entry is known.
+"""
+import gzip
+import json
+import random
+import sys
+from html import escape
+from importlib import resources
+from pathlib import Path
+
+import pandas as pd
+import yaml
+
+# the benchmarks run from the checkout, the package doesn't have to be installed
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+FIXTURES = Path(__file__).parent / 'fixtures'
+
+WORDS = ['Tod', 'Nacht', 'Schatten', 'Spiel', 'Blut', 'Engel', 'Feuer', 'Wasser', 'Stadt', 'Haus', 'Mann', 'Frau',
+         'Kind', 'Wolf', 'Herz', 'Angst', 'Rache', 'Schuld', 'Stille', 'Sturm', 'Winter', 'Sommer', 'Lüge', 'Gift',
+         'Spur', 'Geld', 'Liebe', 'Hass', 'Gott', 'Teufel', 'Himmel', 'Hölle', 'Zeit', 'Wald', 'Fluss', 'Berg',
+         'Mörder', 'Opfer', 'Zeuge', 'Bruder', 'Schwester', 'Vater', 'Mutter', 'König', 'Fremde', 'Nachbar']
+ADJECTIVES = ['tote', 'letzte', 'dunkle', 'kalte', 'falsche', 'stille', 'schwarze', 'weiße', 'verlorene', 'rote']
+PATTERNS = ['{W}', 'Der {a} {W}', 'Die {a} {W}', '{W} und {W2}', 'Im {W}', 'Das {W} der {W2}', '{W} im {W2}',
+            'Am Ende der {W}', '{W} ohne {W2}', 'Die {W} von {city}']
+MONTHS = ['Januar', 'Februar', 'März', 'April', 'Mai', 'Juni', 'Juli', 'August', 'September', 'Oktober',
+          'November', 'Dezember']
+CHANNELS = ['ARD', 'SWR', 'WDR', 'NDR', 'BR', 'ORF', 'SRF']
+COLUMNS = ['Folge', 'Titel', 'Sender', 'Erstausstrahlung', 'Ermittler', 'Fall', 'Autor', 'Regie', 'Besonderheiten']
+
+
+def teams():
+    return yaml.safe_load(resources.read_text('tripper.resources', 'teams.yaml'))
+
+
+def episodes(n=1200, seed=0) -> pd.DataFrame:
+    rng = random.Random(seed)
+    team_list = list(teams().items())
+    rows = []
+    titles = set()
+    for tid in range(1, n + 1):
+        team, city = rng.choice(team_list)
+        city = city.split(',')[0]
+        if rng.random() < .03 and rows:
+            # multi part episodes
+            title = rows[-1]['title'].split(' (')[0] + ' (2)'
+            if not rows[-1]['title'].endswith(')'):
+                rows[-1]['title'] += ' (1)'
+        elif rng.random() < .02 and rows:
+            # different episodes with the same title
+            title = rng.choice(rows)['title']
+        else:
+            while True:
+                title = rng.choice(PATTERNS).format(W=rng.choice(WORDS), W2=rng.choice(WORDS),
+                                                    a=rng.choice(ADJECTIVES), city=city)
+                if title not in titles:
+                    break
+        titles.add(title)
+        year = 1970 + tid * 54 // n
+        rows.append(dict(id=tid, title=title, team=team.replace(',', ' und'), city=city,
+                         airing_date=f'{rng.randint(1, 28)}. {rng.choice(MONTHS)} {year}'))
+    return pd.DataFrame(rows)
+
+
+def wiki_html(episodes_: pd.DataFrame) -> str:
+    header = '<tr>' + ''.join(f'<th>{c}</th>' for c in COLUMNS) + '</tr>'
+    rows = []
+    for i, e in enumerate(episodes_.itertuples()):
+        if i and i % 100 == 0:
+            # the wikipedia table repeats the header
+            rows.append(header)
+        cells = [e.id, e.title, 'ARD', e.airing_date, e.team, i % 40 + 1, 'Autor', 'Regie', '']
+        rows.append('<tr>' + ''.join(f'<td>{escape(str(c))}</td>' for c in cells) + '</tr>')
+    return f'<html><body><table class="wikitable"><thead>{header}</thead><tbody>{"".join(rows)}</tbody></table>' \
+           '</body></html>'
+
+
+def _typo(rng, title):
+    i = rng.randrange(1, max(len(title) - 1, 2))
+    return title[:i] + title[i + 1:] if rng.random() < .5 else title[:i] + title[i:i + 2][::-1] + title[i + 2:]
+
+
+def mediathek_results(episodes_: pd.DataFrame, n=1000, seed=0):
+    """
+    :return: list of mediathekview results, {result id: expected tatort id (None if the result is not a tatort)}
+    """
+    rng = random.Random(seed)
+    results = []
+    labels = dict()
+    for i in range(n):
+        e = episodes_.iloc[rng.randrange(len(episodes_))]
+        r = rng.random()
+        tid = int(e.id)
+        topic = 'Tatort'
+        if r < .45:
+            title = f'Tatort: {e.title}'
+        elif r < .6:
+            title = e.title + rng.choice([' (FSK 12)', ' | tatort', ' (ab 12 Jahre)'])
+        elif r < .75:
+            title = _typo(rng, e.title)
+        elif r < .8:
+            title, tid = e.title + ' (AD)', None
+        elif r < .85:
+            title, topic, tid = rng.choice(WORDS), 'Polizeiruf 110', None
+        elif r < .9:
+            title, topic, tid = f'Tatort: {e.title} - Hörfassung', 'Tatort', None
+        else:
+            title = e.title
+        description = rng.choice([
+            f'Kommissar {e.team.split(" und ")[0]} ermittelt in {e.city}.',
+            f'Ein Fall für {e.team}. Erstausstrahlung {e.airing_date[-4:]}',
+            'Ein spannender Krimi am Sonntagabend.'])
+        channel = rng.choice(CHANNELS)
+        url = f'https://cdn{i % 4}.example.org/{channel.lower()}/{i}.mp4'
+        results.append(dict(channel=channel, topic=topic, title=title, description=description,
+                            timestamp=1700000000 - i * 3600, duration=5400, size=None,
+                            url_website=f'https://example.org/{i}', url_subtitle=f'https://example.org/{i}.xml',
+                            url_video=url, url_video_low=url, url_video_hd=url if i % 3 else '',
+                            filmlisteTimestamp=1700000000, id=f'id{i}'))
+        labels[f'id{i}'] = tid
+        if rng.random() < .1:
+            # the same film is often published by several channels
+            duplicate = dict(results[-1], channel='ARD', id=f'id{i}-ard')
+            results.append(duplicate)
+            labels[duplicate['id']] = tid
+    return results, labels
+
+
+def scale_results(results, factor):
+    """
+    :return: the results repeated factor times with unique ids and urls
+    """
+    return [dict(r, id=f'{r["id"]}-{k}',
+                 url_video=f'{r["url_video"]}?{k}', url_video_low=f'{r["url_video_low"]}?{k}',
+                 url_video_hd=r['url_video_hd'] and f'{r["url_video_hd"]}?{k}')
+            for k in range(factor) for r in results]
+
+
+def scale_html(episodes_: pd.DataFrame, factor) -> str:
+    return wiki_html(pd.concat([episodes_.assign(id=episodes_.id + k * len(episodes_)) for k in range(factor)]))
+
+
+def write_fixtures(path=FIXTURES):
+    path.mkdir(parents=True, exist_ok=True)
+    episodes_ = episodes()
+    results, labels = mediathek_results(episodes_)
+    with gzip.open(path / 'tatort_list.html.gz', 'wt') as f:
+        f.write(wiki_html(episodes_))
+    with gzip.open(path / 'mediathek.json.gz', 'wt') as f:
+        json.dump(dict(result=dict(results=results), err=None), f)
+    (path / 'labels.json').write_text(json.dumps(labels, indent=0))
+
+
+if __name__ == '__main__':
+    write_fixtures()
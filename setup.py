@@ -22,9 +22,14 @@ setup(
         'pandas',
         'lxml',
         'thefuzz',
+        'rapidfuzz',
         'requests',
         'youtube-dl'
     ],
+    extras_require={
+        # typed, memory-mapped caches
+        'arrow': ['pyarrow'],
+    },
     classifiers=[
         'Programming Language :: Python :: 3',
         'Programming Language :: Python :: 3.11',
@@ -0,0 +1,69 @@
+import time
+from datetime import datetime
+from threading import Thread
+
+from tripper.exec.bandwidth import BandwidthLimiter, Window, parse_time
+from tripper.util.metrics import metrics
+
+
+def test_windows():
+    limiter = BandwidthLimiter.from_config(dict(rate_mb=2, windows=[dict(start='01:00', end='07:00'),
+                                                                     dict(start='22:30', end='00:30', rate_mb=0)]))
+    assert limiter.window(datetime(2024, 3, 3, 1, 0)) == Window(60, 420, None)
+    assert limiter.window(datetime(2024, 3, 3, 7, 0)).rate == 2e6
+    # wraps around midnight
+    assert limiter.window(datetime(2024, 3, 3, 0, 15)).rate == 0
+    assert limiter.window(datetime(2024, 3, 3, 23, 0)).rate == 0
+
+    assert limiter.seconds_until_change(datetime(2024, 3, 3, 7, 0)) == (22.5 - 7) * 3600
+    assert limiter.seconds_until_change(datetime(2024, 3, 3, 23, 0)) == 1.5 * 3600
+    assert parse_time('07:05') == 425
+    assert BandwidthLimiter.from_config(dict(windows=[dict(start='01:00', end='07:00')])) is None
+
+
+def test_rate_shared_by_threads():
+    metrics.reset()
+    limiter = BandwidthLimiter([], default_rate=1e6, burst_seconds=.1)
+
+    def download():
+        for _ in range(10):
+            limiter.acquire(10000)
+
+    start = time.perf_counter()
+    threads = [Thread(target=download) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # 300 KB at 1 MB/s, the first 100 KB are the burst
+    assert .18 < time.perf_counter() - start < .5
+
+    limiter.report()
+    assert metrics.get('download_window_bytes', window='default') == 300000
+    assert 5e5 < metrics.get('download_window_throughput_bytes_per_second', window='default') < 2e6
+
+
+def test_wait_open():
+    times = iter([datetime(2024, 3, 3, 6, 59, 59, 900000)] * 3)
+    limiter = BandwidthLimiter([Window(parse_time('01:00'), parse_time('07:00'), 0)],
+                               now=lambda: next(times, datetime(2024, 3, 3, 7, 0)))
+    start = time.perf_counter()
+    limiter.wait_open()
+    assert time.perf_counter() - start < 1
+
+
+def test_pause_finishes_running_transfer():
+    metrics.reset()
+    clock = [datetime(2024, 3, 3, 0, 59)]
+    limiter = BandwidthLimiter([Window(parse_time('01:00'), parse_time('07:00'), 0)], default_rate=1e6,
+                               burst_seconds=.1, now=lambda: clock[0])
+    limiter.acquire(100000)
+    # the pause starts while the chunk is transferred, the remaining bytes are neither throttled nor blocked
+    clock[0] = datetime(2024, 3, 3, 1, 0)
+    start = time.perf_counter()
+    for _ in range(10):
+        limiter.acquire(100000)
+    assert time.perf_counter() - start < .1
+
+    limiter.report()
+    assert metrics.get('download_window_bytes', window='01:00-07:00') == 1000000
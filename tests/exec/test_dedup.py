@@ -0,0 +1,106 @@
+import re
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from threading import Thread
+
+import pytest
+
+from tripper.data_model.fingerprint import FingerprintIndex
+from tripper.exec.dedup import Deduplicator
+from tripper.exec.queue import DownloadJob
+
+MOVIE = bytes(range(256)) * 40
+OTHER = MOVIE[:-1] + b'x'
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    # the same movie is published for several channels
+    files = {'/ard.mp4': MOVIE, '/swr.mp4': MOVIE, '/wdr.mp4': OTHER, '/hr.mp4': b'short'}
+    ranges = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(len(self.files[self.path])))
+        self.end_headers()
+
+    def do_GET(self):
+        self.ranges.append(self.path)
+        start, end = map(int, re.match(r'bytes=(\d+)-(\d+)', self.headers['Range']).groups())
+        content = self.files[self.path][start:end + 1]
+        self.send_response(206)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+@pytest.fixture(scope='module')
+def server():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), RangeHandler)
+    Thread(target=httpd.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{httpd.server_port}'
+    httpd.shutdown()
+
+
+def test_dedup(server, tmp_path):
+    final, output, error = (tmp_path / name for name in ('final', 'output', 'error'))
+    for dir_ in (final, output, error):
+        dir_.mkdir()
+    (error / '[1, 2] Schock.mp4').write_bytes(MOVIE)
+    (final / '1 Tod im All.mp4').write_bytes(b'other content')
+    index = FingerprintIndex(tmp_path / 'fingerprints.sqlite', [final, output, error], sample_bytes=1000)
+
+    jobs = [DownloadJob(f'{server}/ard.mp4', output / '2 Schock.mp4', priority=(0, -2), size=len(MOVIE)),
+            DownloadJob(f'{server}/swr.mp4', error / '[2, 3] Schock.mp4', priority=(1, 0), overwrite=False),
+            DownloadJob(f'{server}/wdr.mp4', error / '[2, 4] Schock.mp4', priority=(1, 1), overwrite=False),
+            DownloadJob(f'{server}/hr.mp4', error / '[5, 6] Kurz.mp4', priority=(1, 2), overwrite=False)]
+    downloads, linked = Deduplicator(index).filter(jobs)
+
+    # the regular download is linked to the check download of the same movie, the other channel is skipped.
+    # The movie with the same size but different content is still downloaded
+    assert linked == jobs[:1]
+    assert (output / '2 Schock.mp4').read_bytes() == MOVIE
+    assert (output / '2 Schock.mp4').stat().st_ino == (error / '[1, 2] Schock.mp4').stat().st_ino
+    assert downloads == jobs[2:]
+    # the unique size is not fingerprinted
+    assert '/hr.mp4' not in RangeHandler.ranges
+
+    # the fingerprints of the urls are cached
+    RangeHandler.ranges.clear()
+    (error / '[1, 2] Schock.mp4').unlink()
+    (output / '2 Schock.mp4').unlink()
+    downloads, linked = Deduplicator(index).filter(jobs[1:3])
+    assert RangeHandler.ranges == [] and linked == []
+    # without the local copies both are downloaded
+    assert downloads == jobs[1:3]
+    assert len(index) == 1
+
+
+def test_duplicate_downloads(server, tmp_path):
+    index = FingerprintIndex(tmp_path / 'fingerprints.sqlite', [tmp_path / 'missing'], sample_bytes=1000)
+    jobs = [DownloadJob(f'{server}/swr.mp4', Path('error/b.mp4'), priority=(1, 1), overwrite=False),
+            DownloadJob(f'{server}/ard.mp4', Path('error/a.mp4'), priority=(1, 0), overwrite=False)]
+    downloads, linked = Deduplicator(index).filter(jobs)
+    assert downloads == jobs[1:] and linked == []
+
+
+def test_queued_in_earlier_cycle(server, tmp_path):
+    index = FingerprintIndex(tmp_path / 'fingerprints.sqlite', [tmp_path / 'missing'], sample_bytes=1000)
+    pending = [DownloadJob(f'{server}/ard.mp4', Path('error/a.mp4'), priority=(1, 0), overwrite=False),
+               DownloadJob(f'{server}/wdr.mp4', Path('error/c.mp4'), priority=(1, 2), overwrite=False)]
+    jobs = [DownloadJob(f'{server}/swr.mp4', Path('error/b.mp4'), priority=(1, 1), overwrite=False),
+            DownloadJob(f'{server}/wdr.mp4', Path('error/c.mp4'), priority=(1, 2), overwrite=False)]
+    # the other channel of the queued movie is skipped, the job that is planned again is kept
+    downloads, linked = Deduplicator(index).filter(jobs, pending)
+    assert downloads == jobs[1:] and linked == []
+
+
+def test_no_jobs(tmp_path):
+    (tmp_path / 'a.mp4').write_bytes(MOVIE)
+    index = FingerprintIndex(tmp_path / 'fingerprints.sqlite', [tmp_path], sample_bytes=1000)
+    # nothing to check, hence the local files are not scanned
+    assert Deduplicator(index).filter([]) == ([], [])
+    assert len(index) == 0
@@ -0,0 +1,102 @@
+import re
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+
+import pytest
+
+from tripper.exec.downloader import RangeDownloader, RangeDownloadError
+
+CONTENT = bytes(range(256)) * 1000
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    requested = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.send_response(200)
+        if self.path.endswith('ranges.mp4'):
+            self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(len(CONTENT)))
+        self.end_headers()
+
+    def do_GET(self):
+        start, end = map(int, re.match(r'bytes=(\d+)-(\d+)', self.headers['Range']).groups())
+        self.requested.append(start)
+        self.send_response(206)
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        self.wfile.write(CONTENT[start:end + 1])
+
+
+@pytest.fixture(scope='module')
+def server():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), RangeHandler)
+    Thread(target=httpd.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{httpd.server_port}'
+    httpd.shutdown()
+
+
+@pytest.fixture
+def downloader():
+    return RangeDownloader(connections=3, chunk_size_mb=50000 / 2 ** 20)
+
+
+def test_supports():
+    assert RangeDownloader.supports('https://example.org/video.mp4')
+    assert not RangeDownloader.supports('https://example.org/master.m3u8')
+
+
+def test_download_and_resume(server, downloader, tmp_path):
+    dest = tmp_path / 'video.mp4'
+    hooks = []
+    assert downloader.download(f'{server}/ranges.mp4', dest, expected_size=len(CONTENT), progress_hooks=[hooks.append])
+    assert dest.read_bytes() == CONTENT
+    assert hooks[-1]['status'] == 'finished'
+
+    # simulate an interrupted download, where only the second chunk is missing
+    part, state = RangeDownloader.part_files(dest)
+    part.write_bytes(CONTENT[:50000] + bytes(50000) + CONTENT[100000:])
+    state.write_text(f'{{"url": "{server}/ranges.mp4", "size": {len(CONTENT)}, "chunk_size": 50000,'
+                     f' "done": [0, 2, 3, 4, 5]}}')
+    RangeHandler.requested.clear()
+    assert downloader.download(f'{server}/ranges.mp4', dest)
+    assert RangeHandler.requested == [50000]
+    assert dest.read_bytes() == CONTENT
+    assert not part.exists() and not state.exists()
+
+
+def test_discard_partial_download_of_other_url(server, downloader, tmp_path):
+    dest = tmp_path / 'video.mp4'
+    part, state = RangeDownloader.part_files(dest)
+    part.write_bytes(bytes(len(CONTENT)))
+    state.write_text(f'{{"url": "{server}/old/ranges.mp4", "size": {len(CONTENT)}, "chunk_size": 50000,'
+                     f' "done": [0, 1, 2, 3, 4]}}')
+    RangeHandler.requested.clear()
+    assert downloader.download(f'{server}/ranges.mp4', dest)
+    assert sorted(RangeHandler.requested) == list(range(0, len(CONTENT), 50000))
+    assert dest.read_bytes() == CONTENT
+
+
+def test_wait_open_before_each_chunk(server, tmp_path):
+    calls = []
+
+    class Limiter:
+        def wait_open(self):
+            calls.append('wait_open')
+
+        def acquire(self, n):
+            calls.append(n)
+
+    downloader = RangeDownloader(connections=3, chunk_size_mb=50000 / 2 ** 20, limiter=Limiter())
+    assert downloader.download(f'{server}/ranges.mp4', tmp_path / 'video.mp4')
+    assert calls.count('wait_open') == 6
+    assert sum(n for n in calls if n != 'wait_open') == len(CONTENT)
+
+
+def test_no_ranges_and_size_mismatch(server, downloader, tmp_path):
+    assert not downloader.download(f'{server}/plain.mp4', tmp_path / 'video.mp4')
+    with pytest.raises(RangeDownloadError):
+        downloader.download(f'{server}/ranges.mp4', tmp_path / 'video.mp4', expected_size=2 * len(CONTENT))
@@ -0,0 +1,109 @@
+import json
+import shutil
+import subprocess
+from types import SimpleNamespace
+
+import pytest
+
+from tripper.data_model.inventory import CollectionInventory
+from tripper.data_model.probe_cache import ProbeCache, ProbeResult
+from tripper.exec import postprocess
+from tripper.exec.postprocess import PostProcessor
+
+
+@pytest.fixture
+def folders(tmp_path):
+    output, error = tmp_path / 'output', tmp_path / 'error'
+    output.mkdir()
+    return output, error
+
+
+def ffprobe(duration, returncode=0, stderr=b'', bit_rate='1000000'):
+    def run(cmd, **kwargs):
+        if cmd[0] != 'ffprobe':
+            raise AssertionError(cmd)
+        info = dict(format=dict(duration=str(duration), bit_rate=bit_rate),
+                    streams=[dict(codec_type='video', height=720), dict(codec_type='audio')])
+        return SimpleNamespace(returncode=returncode, stdout=json.dumps(info).encode(), stderr=stderr)
+
+    return run
+
+
+def test_verify_and_quarantine(folders, tmp_path, monkeypatch):
+    output, error = folders
+    (output / '1000 Foo.mp4').write_bytes(b'0' * 10)
+    (output / '1000 Foo.vtt').write_text('WEBVTT')
+    (output / '1001 Bar.mp4').write_bytes(b'0' * 10)
+    inventory = CollectionInventory(tmp_path / 'inventory.json', [output])
+    probes = ProbeCache(tmp_path / 'probes.sqlite')
+    probes.put('https://a/1000.mp4', ProbeResult(5400., 1e9, 'ffmpeg'))
+    probes.put('https://a/1001.mp4', ProbeResult(5400., 1e9, 'ffmpeg'))
+    processor = PostProcessor(error, inventory=inventory, probe_cache=probes)
+
+    monkeypatch.setattr(postprocess, 'run', ffprobe(5390.))
+    assert processor.process('https://a/1000.mp4', output / '1000 Foo.mp4') == 'verified'
+    entry = inventory.best(1000)
+    assert entry.verified and entry.probed and entry.height == 720
+    # the lookup of the expected duration is not counted as a cache hit
+    assert probes.hits == 0
+
+    # truncated download
+    monkeypatch.setattr(postprocess, 'run', ffprobe(3000.))
+    assert processor.process('https://a/1001.mp4', output / '1001 Bar.mp4') == 'quarantined'
+    assert (error / '1001 Bar.mp4').exists() and not (output / '1001 Bar.mp4').exists()
+
+    # the verified metadata survives the next scan
+    inventory = CollectionInventory(tmp_path / 'inventory.json', [output])
+    assert inventory.best(1000).verified and inventory.best(1001) is None
+
+
+def test_warnings_do_not_quarantine(folders, monkeypatch):
+    output, error = folders
+    path = output / '1000 Foo.mp4'
+    processor = PostProcessor(error)
+
+    monkeypatch.setattr(postprocess, 'run', ffprobe(5400., stderr=b'[mov,mp4] Application provided invalid, '
+                                                                    b'non monotonically increasing dts'))
+    assert processor.verify(path, 5400.).failure is None
+    monkeypatch.setattr(postprocess, 'run', ffprobe(5400., returncode=1, stderr=b'moov atom not found'))
+    assert processor.verify(path, 5400.).failure == 'corrupt'
+
+
+def test_missing_bit_rate_and_hooks(folders, monkeypatch):
+    output, error = folders
+    (output / '1000 Foo.mp4').write_bytes(b'0' * 5400)
+    (output / '1001 Bar.mp4').write_bytes(b'0' * 10)
+    results = []
+    processor = PostProcessor(error, hooks=[lambda url, dest, result: results.append((url, dest.name, result))])
+
+    # the bit rate is N/A for some containers, the average bit rate is used instead
+    monkeypatch.setattr(postprocess, 'run', ffprobe(5400., bit_rate='N/A'))
+    assert processor.verify(output / '1000 Foo.mp4').bit_rate == 8
+    processor.submit('https://a/1000.mp4', output / '1000 Foo.mp4')
+    processor.join()
+    monkeypatch.setattr(postprocess, 'run', ffprobe(5400., returncode=1))
+    processor.submit('https://a/1001.mp4', output / '1001 Bar.mp4')
+    processor.join()
+    assert results == [('https://a/1000.mp4', '1000 Foo.mp4', 'verified'),
+                       ('https://a/1001.mp4', '1001 Bar.mp4', 'quarantined')]
+
+
+@pytest.mark.skipif(not PostProcessor.available(), reason='ffmpeg is not installed')
+def test_remux(folders, tmp_path):
+    output, error = folders
+    movie = output / '1000 Foo.mp4'
+    subprocess.run(['ffmpeg', '-v', 'error', '-f', 'lavfi', '-i', 'testsrc=duration=2:size=320x240:rate=25',
+                    '-c:v', 'mpeg4', str(movie)], check=True)
+    (output / '1000 Foo.vtt').write_text('WEBVTT\n\n00:00.000 --> 00:01.000\nHallo\n')
+    shutil.copy(movie, output / '1001 Bar.mp4')
+    with open(output / '1001 Bar.mp4', 'r+b') as f:
+        f.truncate(movie.stat().st_size // 2)
+
+    processor = PostProcessor(error, remux=True)
+    processor.submit('https://a/1000.mp4', movie)
+    processor.submit('https://a/1001.mp4', output / '1001 Bar.mp4')
+    processor.join()
+    assert not (output / '1001 Bar.mp4').exists() and (error / '1001 Bar.mp4').exists()
+    streams = json.loads(subprocess.check_output(['ffprobe', '-v', 'quiet', '-of', 'json', '-show_streams',
+                                                  str(movie)]))['streams']
+    assert {stream['codec_type'] for stream in streams} == {'video', 'subtitle'}
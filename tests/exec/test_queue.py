@@ -0,0 +1,47 @@
+from pathlib import Path
+
+from tripper.exec.queue import DownloadJob, DownloadQueue
+
+
+def test_queue(tmp_path):
+    queue = DownloadQueue(tmp_path / 'queue.sqlite')
+    queue.put(DownloadJob('https://a/1.mp4', Path('out/1.mp4'), priority=(0, -1), size=100, url_subtitle='s'))
+    queue.put(DownloadJob('https://a/2.mp4', Path('check/2.mp4'), priority=(1, 0), overwrite=False))
+    # a smaller version does not replace the queued job, a larger does
+    queue.put(DownloadJob('https://b/1.mp4', Path('out/1.mp4'), priority=(0, -1), size=50))
+    assert queue.pending()[0].url == 'https://a/1.mp4'
+    queue.put(DownloadJob('https://c/1.mp4', Path('out/1.mp4'), priority=(0, -1), size=200))
+    assert len(queue) == 2
+
+    queue.failed(Path('check/2.mp4'))
+    queue.done(Path('out/1.mp4'))
+    queue.close()
+
+    # the queue survives restarts
+    queue = DownloadQueue(tmp_path / 'queue.sqlite')
+    assert queue.pending() == [DownloadJob('https://a/2.mp4', Path('check/2.mp4'), priority=(1, 0), overwrite=False,
+                                           title='', attempts=1)]
+    assert queue.pending(max_attempts=1) == []
+
+
+def test_exhausted_job_is_replaced_by_another_url(tmp_path):
+    queue = DownloadQueue(tmp_path / 'queue.sqlite')
+    queue.put(DownloadJob('https://a/1.mp4', Path('out/1.mp4'), priority=(0, -1), size=100))
+    for _ in range(3):
+        queue.failed(Path('out/1.mp4'))
+    # the same url stays exhausted
+    queue.put(DownloadJob('https://a/1.mp4', Path('out/1.mp4'), priority=(0, -1), size=100))
+    assert queue.pending() == []
+
+    queue.put(DownloadJob('https://b/1.mp4', Path('out/1.mp4'), priority=(0, -1), size=90))
+    assert [(job.url, job.attempts) for job in queue.pending()] == [('https://b/1.mp4', 0)]
+
+
+def test_retry(tmp_path):
+    queue = DownloadQueue(tmp_path / 'queue.sqlite')
+    job = DownloadJob('https://a/1.mp4', Path('out/1.mp4'), priority=(0, -1), size=100, attempts=1)
+    queue.put(job)
+    queue.done(job.dest)
+    # the download failed the verification after it was done
+    queue.retry(job)
+    assert queue.pending() == [job._replace(attempts=2)]
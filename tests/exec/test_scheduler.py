@@ -0,0 +1,38 @@
+import time
+from pathlib import Path
+from threading import Lock
+
+from tripper.exec.scheduler import DownloadScheduler
+
+
+def test_priority_and_host_limit():
+    started = []
+    active = dict()
+    max_active = dict()
+    lock = Lock()
+
+    def download(url, dest, overwrite, progress_hooks, size):
+        host = url.split('/')[2]
+        with lock:
+            started.append(dest.name)
+            active[host] = active.get(host, 0) + 1
+            max_active[host] = max(max_active.get(host, 0), active[host])
+        time.sleep(.05)
+        with lock:
+            active[host] -= 1
+
+    scheduler = DownloadScheduler(download, workers=1, per_host=1)
+    scheduler.submit('https://b/3', Path('check'), priority=(1, 0), overwrite=False)
+    for tid in [1, 3, 2]:
+        scheduler.submit(f'https://a/{tid}', Path(str(tid)), priority=(0, -tid))
+    scheduler.run()
+    assert started == ['3', '2', '1', 'check']
+
+    scheduler = DownloadScheduler(download, workers=4, per_host=2)
+    for i in range(6):
+        scheduler.submit(f'https://{"ab"[i % 2]}/{i}', Path(str(i)))
+    sides = []
+    scheduler.submit_side(sides.append, 'subtitle')
+    scheduler.run()
+    assert max_active == dict(a=2, b=2)
+    assert sides == ['subtitle']
@@ -0,0 +1,21 @@
+import subprocess
+import sys
+from pathlib import Path
+
+from click.testing import CliRunner
+
+from tripper.cli import main
+
+
+def test_help():
+    result = CliRunner().invoke(main, ['--help'])
+    assert result.exit_code == 0
+    assert 'daemon' in result.output
+
+
+def test_lazy_imports():
+    # the cli must start fast, the heavy dependencies are only imported when they are needed
+    code = 'import sys, tripper.cli; print(" ".join(sorted(sys.modules)))'
+    modules = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True,
+                             cwd=Path(__file__).parent.parent).stdout.split()
+    assert not {'pandas', 'requests', 'youtube_dl', 'lxml'} & set(modules)
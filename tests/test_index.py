@@ -0,0 +1,62 @@
+from operator import itemgetter
+
+import pandas as pd
+import pytest
+from thefuzz import process
+
+from tripper.data_model.index import TitleIndex, strip_brackets
+
+
+@pytest.fixture
+def episodes():
+    titles = ['Murot und das Murmeltier', 'Spielverderber', 'Der Tod ist unser ganzes Leben',
+              'Wer bin ich?', 'Im toten Winkel', 'Das Haus am Ende der Straße', 'Tod im All',
+              'Der Fluch des Geldes', 'Borowski und das Land zwischen den Meeren',
+              'Es lebe der Tod', 'Das Wunder von Wolbeck', 'Schock (1)', 'Schock (2)', 'Schock (2)']
+    return pd.DataFrame(dict(title=titles, meta_data=[{'2020', 'Köln'}] * len(titles)),
+                        index=pd.Index(range(1000, 1000 + len(titles)), name='id'))
+
+
+@pytest.fixture
+def index(episodes):
+    return TitleIndex(episodes)
+
+
+def test_multimaps(index):
+    assert index.ids_by_title['Schock (2)'] == [1012, 1013]
+    assert index.ids_by_stripped['Schock'] == [1011, 1012, 1013]
+    assert strip_brackets('Schock (2)') == 'Schock'
+
+
+def relevant(matches):
+    # only the best match and the matches above the threshold are relevant for the prediction
+    return {(t, score) for t, score in matches if score > 90 or score == matches[0][1]}
+
+
+TITLES = ['Murot und das Murmletier', 'Spielverderber 2', 'Tod im Weltall', 'Borowski und das Land zwischen Meeren',
+          'Schock', 'Xyz', 'Der Tod', 'Das Land']
+
+
+@pytest.mark.parametrize('shortlist_size', [64, 2])
+@pytest.mark.parametrize('title', TITLES)
+def test_extract_equals_full_scan(episodes, title, shortlist_size):
+    # with 2 titles the shortlist is smaller than the table and decides the result
+    index = TitleIndex(episodes, shortlist_size=shortlist_size)
+    expected = sorted(process.extract(title, set(episodes.title)), key=itemgetter(1), reverse=True)
+    assert relevant(index.extract(title, score_cutoff=90)) == relevant(expected)
+
+
+@pytest.mark.parametrize('title, scored', [('Spielverderber 2', [2]),
+                                           # the best shortlisted score is at or below the cutoff
+                                           ('Schock', [2, 13]), ('Tod im Weltall', [2, 13]),
+                                           # nothing is shortlisted
+                                           ('Xyz', [13])])
+def test_extract_falls_back_to_full_scan(episodes, monkeypatch, title, scored):
+    index = TitleIndex(episodes, shortlist_size=2)
+    sizes = []
+    score = index._score
+    monkeypatch.setattr(index, '_score', lambda key, candidates, limit:
+                        sizes.append(len(candidates)) or score(key, candidates, limit))
+    index.extract(title, score_cutoff=90)
+    assert sizes == scored
+
@@ -0,0 +1,28 @@
+import os
+
+from tripper.data_model.inventory import CollectionInventory
+
+
+def test_inventory(tmp_path):
+    final, output = tmp_path / 'final', tmp_path / 'output'
+    final.mkdir()
+    output.mkdir()
+    (final / '1000 Foo.mp4').write_bytes(b'0' * 10)
+    (output / '1000 Foo.mp4').write_bytes(b'0' * 20)
+    (output / '1001 Bar.mp4').write_bytes(b'0' * 5)
+    (output / 'unknown.mp4').write_bytes(b'0')
+
+    inventory = CollectionInventory(tmp_path / 'inventory.json', [final, output])
+    assert inventory.sizes() == {1000: 20, 1001: 5}
+    assert inventory.duplicates() == {1000: [str(output / '1000 Foo.mp4'), str(final / '1000 Foo.mp4')]}
+
+    # unchanged directories are not rescanned
+    (final / '1000 Foo.mp4').write_bytes(b'0' * 30)
+    os.utime(final, (final.stat().st_atime, final.stat().st_mtime))
+    inventory = CollectionInventory(tmp_path / 'inventory.json', [final, output])
+    assert inventory.sizes()[1000] == 20
+
+    (output / '1000 Foo.mp4').unlink()
+    inventory = CollectionInventory(tmp_path / 'inventory.json', [final, output])
+    assert inventory.best(1000).path == str(final / '1000 Foo.mp4')
+    assert inventory.duplicates() == {}
@@ -0,0 +1,39 @@
+import pandas as pd
+import pytest
+
+from tripper.data_model.index import TitleIndex
+from tripper.data_model.matching import TitleMatcher
+from tripper.util.metrics import metrics
+
+
+@pytest.fixture
+def matcher():
+    titles = ['Murot und das Murmeltier', 'Spielverderber', 'Der Tod ist unser ganzes Leben',
+              'Wer bin ich?', 'Im toten Winkel', 'Tod im All', 'Schock (1)', 'Schock (2)', 'Angst', 'Angst']
+    meta_data = [{'2015', 'Wiesbaden'}] * 6 + [{'2017', 'Wien'}, {'2017', 'Köln'}] + \
+                [{'1998', 'Leipzig'}, {'2009', 'Bremen'}]
+    episodes = pd.DataFrame(dict(title=titles, meta_data=meta_data),
+                            index=pd.Index(range(1000, 1000 + len(titles)), name='id'))
+    return TitleMatcher(TitleIndex(episodes), title_thresh=90, desc_thresh=60)
+
+
+def test_predict(matcher):
+    assert matcher.predict('Spielverderber', '') == [1001]
+    assert matcher.predict('Murot und das Murmletier', '') == [1000]
+    assert matcher.predict('Schock', 'Ein Fall aus Wien im Jahr 2017') == [1006]
+
+
+def test_predict_exact_title_of_several_episodes(matcher):
+    # an exact title is not enough if several episodes share it
+    assert matcher.predict('Angst', 'Ein Fall aus Bremen im Jahr 2009') == [1009]
+    assert matcher.predict('Angst', 'Leipzig 1998') == [1008]
+
+
+def test_predict_many_in_processes(matcher):
+    rows = [('Murot und das Murmletier', ''), ('Tod im Weltall', ''), ('Schock', 'Köln 2017'),
+            ('Xyz', ''), ('Wer bin ich', '')] * 5
+    expected = matcher.predict_many(rows)
+    metrics.reset()
+    assert matcher.predict_many(rows, workers=2, chunk_size=4) == expected
+    # the rows matched in the worker processes are timed as well
+    assert metrics.to_dict()['timers']['match_row']['count'] == len(rows)
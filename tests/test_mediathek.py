@@ -1,6 +1,97 @@
+import time
+
+import pytest
+
 from tripper.data_model import MediathekWrapper
+from tripper.data_model.mediathek import ResultFilter
 
 
 def test__get_mediathek():
     for tatort in MediathekWrapper(cache_dir='tmp', mediathek_query_size=1):
         print(tatort)
+
+
+def _result(i, timestamp):
+    return dict(id=f'id{i}', channel='ARD', topic='Tatort', title=f'Tatort: Title {i}', description='', duration=5400,
+                timestamp=timestamp, filmlisteTimestamp=timestamp, url_video=f'https://example.org/{i}.mp4',
+                url_video_low='', url_video_hd='', url_subtitle='', url_website='')
+
+
+def test_incremental_sync(tmp_path):
+    results = [_result(i, 1000 - i) for i in range(10)]
+    queries = []
+
+    class OfflineMediathekWrapper(MediathekWrapper):
+        def _query(self, offset, size):
+            queries.append((offset, size))
+            return iter(results[offset:offset + size])
+
+    tatorte = OfflineMediathekWrapper(cache_dir=tmp_path, mediathek_query_size=8, incremental=True, page_size=3)
+    assert len(tatorte.new) == len(tatorte) == 8
+
+    results[:0] = [_result(21, 2001), _result(20, 2000)]
+    queries.clear()
+    tatorte = OfflineMediathekWrapper(cache_dir=tmp_path, mediathek_query_size=8, incremental=True, page_size=3)
+    assert list(tatorte.new.index) == ['id21', 'id20']
+    assert list(tatorte.new.title) == ['Title 21', 'Title 20']
+    assert len(tatorte) == 10
+    # the second page is known
+    assert queries == [(0, 3), (3, 3)]
+
+
+def test_incremental_sync_future_and_expired(tmp_path):
+    future = time.time() + 10 ** 6
+    results = [_result(i, future - i) for i in range(4)] + [_result(i, 1000 - i) for i in range(4, 10)]
+
+    class OfflineMediathekWrapper(MediathekWrapper):
+        def _query(self, offset, size):
+            return iter(results[offset:offset + size])
+
+    OfflineMediathekWrapper(cache_dir=tmp_path, mediathek_query_size=10, incremental=True, page_size=3)
+    # the known future broadcasts fill the first page, the new entries follow them
+    results[4:4] = [_result(21, 2001), _result(20, 2000)]
+    tatorte = OfflineMediathekWrapper(cache_dir=tmp_path, mediathek_query_size=10, incremental=True, page_size=3)
+    assert list(tatorte.new.index) == ['id21', 'id20']
+    assert len(tatorte) == 12
+
+    # the full sync removes the entries that are not listed anymore
+    del results[1]
+    tatorte = OfflineMediathekWrapper(cache_dir=tmp_path, mediathek_query_size=20, incremental=True, page_size=3,
+                                      full_sync_days=0)
+    assert len(tatorte.new) == 0
+    assert len(tatorte) == 11 and 'id1' not in tatorte.mediathek.index
+
+
+def test_rules_invalidate_cache(tmp_path):
+    results = [_result(i, 1000 - i) for i in range(5)]
+
+    class OfflineMediathekWrapper(MediathekWrapper):
+        def _query(self, offset, size):
+            return iter(results[offset:offset + size])
+
+    OfflineMediathekWrapper(cache_dir=tmp_path, mediathek_query_size=5, incremental=True, page_size=5)
+    rules = dict(exclude=dict(title=['Title 3']))
+    assert ResultFilter(**rules).fingerprint != ResultFilter().fingerprint
+    with pytest.raises(FileNotFoundError):
+        MediathekWrapper(cache_dir=tmp_path, mediathek_query_size=5, incremental=True, offline=True, rules=rules)
+
+    # the known entries are filtered again with the new rules
+    tatorte = OfflineMediathekWrapper(cache_dir=tmp_path, mediathek_query_size=5, incremental=True, page_size=5,
+                                      rules=rules)
+    assert list(tatorte.mediathek.index) == ['id0', 'id1', 'id2', 'id4']
+    assert len(MediathekWrapper(cache_dir=tmp_path, mediathek_query_size=5, incremental=True, offline=True,
+                                rules=rules)) == 4
+
+
+def test_result_filter():
+    tatorte = MediathekWrapper._process([
+        _result(1, 0),
+        dict(_result(2, 0), title='Tatort: Title 2 (AD)'),
+        dict(_result(3, 0), topic='Polizeiruf 110', title='Title 3'),
+        dict(_result(4, 0), title='Title 4 (FSK 12)'),
+        dict(_result(5, 0), topic='Krimi', title='Title 5'),
+    ])
+    assert list(tatorte.title) == ['Title 1', 'Title 4']
+
+    result_filter = ResultFilter(exclude=dict(title=['4']), title_cleanup=[])
+    assert list(MediathekWrapper._process([_result(1, 0), _result(4, 0)], result_filter).title) == ['Tatort: Title 1']
@@ -1,6 +1,10 @@
+import pandas as pd
 import pytest
 
 from tripper.data_model import WikipediaWrapper
+from tripper.data_model.inventory import CollectionInventory
+from tripper.data_model.metadata import CityPredictor
+from tripper.util.metrics import metrics
 
 
 @pytest.fixture
@@ -24,3 +28,39 @@ def test_try_predict_id(processor):
 def test_try_predict_id2(processor):
     print(processor.try_predict_id('Spielverderber', 'Schimanski '))
     assert True
+
+
+def test_city_predictor():
+    teams = pd.Series(['Thiel und Boerne', 'Boerne, Thiel', 'Thiel und Boerne', 'Unbekannt', None],
+                      index=[3, 1, 2, 7, 9])
+    cities = CityPredictor()(teams)
+    assert list(cities.index) == [3, 1, 2, 7, 9]
+    assert cities[3] == cities[1] == cities[2] == 'Münster'
+    assert cities[7].endswith('??')
+    assert pd.isna(cities[9])
+
+
+def test_parse_wiki_tatortlist_missing_team():
+    columns = ['Folge', 'Titel', 'Sender', 'Erstausstrahlung', 'Ermittler', 'Fall', 'Autor', 'Regie',
+               'Besonderheiten']
+    rows = [['1', 'Taxi nach Leipzig', 'NDR', '29. Nov. 1970', 'Trimmel', '1', 'Hansen', 'Schübel', ''],
+            ['2', 'Saarbrücken, an einem Montag …', 'SR', '3. Jan. 1971', '', '1', 'Sippel', 'Ellmer', '']]
+    html = '<table><tr>' + ''.join(f'<th>{column}</th>' for column in columns) + '</tr>' + \
+           ''.join('<tr>' + ''.join(f'<td>{cell}</td>' for cell in row) + '</tr>' for row in rows) + '</table>'
+    episodes = WikipediaWrapper._parse_wiki_tatortlist(html)
+    assert 'Trimmel' in episodes.meta_data[0] and '1970' in episodes.meta_data[0]
+    # the year is kept for the episode without team
+    assert pd.isna(episodes.team[1]) and pd.isna(episodes.city[1])
+    assert episodes.meta_data[1] == {'1971'}
+
+
+def test_offline_does_not_probe(tmp_path, monkeypatch):
+    (tmp_path / '1000 Foo.mp4').write_bytes(b'0' * 10)
+    # only the inventory is needed, not the wikipedia list
+    model = object.__new__(WikipediaWrapper)
+    model.offline = True
+    model.inventory = CollectionInventory(tmp_path / 'inventory.json', [tmp_path])
+    monkeypatch.setattr(model.inventory, 'probe_many', lambda *args, **kwargs: pytest.fail('probed offline'))
+    metrics.reset()
+    model._probe_inventory([1000, 1000, 1001])
+    assert metrics.get('inventory_unprobed') == 1
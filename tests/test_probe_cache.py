@@ -0,0 +1,33 @@
+import time
+
+import pytest
+
+from tripper.data_model.probe_cache import DAY, ProbeCache, ProbeResult
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return ProbeCache(tmp_path / 'probes.sqlite', ttl_days=7, negative_ttl_days=1, max_entries=2)
+
+
+def test_hit_and_miss(cache):
+    assert cache.get('a') is None
+    cache.put('a', ProbeResult(5400., 2e9, 'ffmpeg'))
+    assert cache.get('a')[:3] == (5400., 2e9, 'ffmpeg')
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_negative_ttl(cache):
+    cache.put('geo', ProbeResult(None, None, 'ffmpeg', 'geoblocked', time.time() - 2 * DAY))
+    cache.put('ok', ProbeResult(5400., 2e9, 'ffmpeg', None, time.time() - 2 * DAY))
+    assert cache.get('geo') is None
+    assert cache.get('ok') is not None
+
+
+def test_evict(cache):
+    for i in range(3):
+        cache.put(str(i), ProbeResult(5400., 2e9, 'ffmpeg', None, time.time() - i))
+    cache.put('old', ProbeResult(5400., 2e9, 'ffmpeg', None, time.time() - 8 * DAY))
+    cache.evict()
+    assert len(cache) == 2
+    assert cache.get('0') is not None and cache.get('2') is None
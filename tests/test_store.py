@@ -0,0 +1,37 @@
+import pandas as pd
+import pytest
+
+from tripper.data_model import store as store_module
+from tripper.data_model.store import TableStore
+
+
+@pytest.fixture(params=['feather', 'csv', 'pickle'])
+def fmt(request, monkeypatch):
+    if request.param == 'feather':
+        if store_module.pa is None:
+            pytest.skip('pyarrow is not installed')
+    else:
+        monkeypatch.setattr(store_module, 'pa', None)
+    return request.param
+
+
+def test_roundtrip(fmt, tmp_path):
+    df = pd.DataFrame(dict(title=['a', 'b'], timestamp=[1, 2]), index=pd.Index(['x', 'y'], name='id'))
+    set_columns = []
+    if fmt != 'csv':
+        set_columns = ['bag']
+        df['bag'] = [{'foo', 'bar'}, set()]
+    store = TableStore(tmp_path / 'table', version=1, fallback='pickle' if fmt == 'pickle' else 'csv',
+                       set_columns=set_columns)
+    store.write(df)
+
+    assert store.format == fmt
+    pd.testing.assert_frame_equal(store.read(), df)
+    assert store.read(max_age_days=1) is not None
+
+
+def test_version_invalidates(fmt, tmp_path):
+    TableStore(tmp_path / 'table', version=1).write(pd.DataFrame(dict(title=['a'])))
+    assert TableStore(tmp_path / 'table', version=1).read() is not None
+    assert TableStore(tmp_path / 'table', version=2).read() is None
+    assert list(tmp_path.glob('*.tmp')) == []
@@ -0,0 +1,61 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+
+import pytest
+
+from tripper.util.http import HttpCache
+
+
+class ETagHandler(BaseHTTPRequestHandler):
+    content = b'<html>' + b'x' * 100000 + b'</html>'
+    etag = '"1"'
+    requests = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.requests.append(self.headers.get('If-None-Match'))
+        if self.headers.get('If-None-Match') == self.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', self.etag)
+        self.send_header('Content-Length', str(len(self.content)))
+        self.end_headers()
+        self.wfile.write(self.content)
+
+
+@pytest.fixture(scope='module')
+def server():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), ETagHandler)
+    Thread(target=httpd.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{httpd.server_port}'
+    httpd.shutdown()
+
+
+def test_conditional_requests(server, tmp_path):
+    cache = HttpCache(tmp_path)
+    response = cache.request('page', f'{server}/page')
+    assert response.changed and response.content == ETagHandler.content
+    body, meta = cache.paths('page')
+    # stored compressed
+    assert body.stat().st_size < 1000
+
+    response = cache.request('page', f'{server}/page')
+    assert not response.changed and response.content == ETagHandler.content
+
+    ETagHandler.etag, ETagHandler.content = '"2"', b'<html>changed</html>'
+    response = cache.request('page', f'{server}/page')
+    assert response.changed and response.content == b'<html>changed</html>'
+    assert ETagHandler.requests == [None, '"1"', '"1"']
+
+
+def test_incomplete_read(server, tmp_path):
+    cache = HttpCache(tmp_path)
+    chunks = cache.request('page', f'{server}/page').iter_content()
+    next(chunks)
+    chunks.close()
+    # the body was not read completely, hence nothing is cached
+    assert not any(path.exists() for path in cache.paths('page'))
@@ -0,0 +1,33 @@
+from tripper.util.metrics import Metrics
+
+
+def test_metrics():
+    metrics = Metrics()
+    metrics.inc('probe_cache', result='hit')
+    metrics.inc('probe_cache', result='hit')
+    metrics.inc('download_bytes', 100)
+    metrics.set('throughput', 2.5)
+    with metrics.timer('stage', stage='matching'):
+        pass
+    metrics.observe('stage', 7, stage='matching')
+
+    assert metrics.get('probe_cache', result='hit') == 2
+    assert metrics.get('probe_cache', result='miss') == 0
+    d = metrics.to_dict()
+    assert d['counters']['download_bytes'] == 100
+    assert d['timers']['stage{stage="matching"}']['count'] == 2
+
+    prom = metrics.to_prometheus()
+    assert 'tripper_probe_cache_total{result="hit"} 2' in prom
+    assert 'tripper_stage_seconds_bucket{stage="matching",le="10"} 2' in prom
+    assert 'tripper_stage_seconds_bucket{stage="matching",le="5"} 1' in prom
+    assert 'tripper_stage_seconds_count{stage="matching"} 2' in prom
+    assert 'stage{stage="matching"}' in metrics.summary()
+
+
+def test_write(tmp_path):
+    metrics = Metrics()
+    metrics.inc('downloads')
+    metrics.write(json_path=tmp_path / 'metrics.json', prometheus_path=tmp_path / 'tripper.prom')
+    assert (tmp_path / 'tripper.prom').read_text() == 'tripper_downloads_total 1.0\n'
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['metrics.json', 'tripper.prom']
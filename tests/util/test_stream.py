@@ -0,0 +1,20 @@
+import json
+
+import pytest
+
+from tripper.util.stream import iter_json_array
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 1000])
+def test_iter_json_array(chunk_size):
+    items = [dict(id=i, title=f'Tätort [{i}], "{{x}}"', nested=[1, {'a': None}]) for i in range(20)]
+    document = json.dumps(dict(result=dict(results=items, queryInfo=dict(totalResults=20)), err=None)).encode()
+    chunks = (document[i:i + chunk_size] for i in range(0, len(document), chunk_size))
+    assert list(iter_json_array(chunks, 'results', compact_after=10)) == items
+
+
+def test_empty_and_missing():
+    assert list(iter_json_array([b'{"results": [ ]}'], 'results')) == []
+    assert list(iter_json_array([b'{"other": [{"a": 1}]}'], 'results')) == []
+    with pytest.raises(json.JSONDecodeError):
+        list(iter_json_array([b'{"results": [{"a": 1}, {"a"'], 'results'))
@@ -1,15 +1,20 @@
+import cProfile
 import logging
 
 import click
 import yaml
 
-from tripper.exec import Runner
 
-
-@click.command()
+@click.group(invoke_without_command=True)
 @click.option('--config', default='config.yaml', help='Config file')
 @click.option('--loglevel', default=logging.INFO, help='Config file')
-def main(config, loglevel, **kwargs):
+@click.option('--profile', default=None, help='Dump a cProfile of the run to this file')
+@click.option('--check', is_flag=True, help='Only report what would be downloaded, using the cached data')
+@click.pass_context
+def main(ctx, config, loglevel, profile, check, **kwargs):
+    """
+    Without a command, all new episodes are downloaded once (e.g. started by a systemd timer)
+    """
     logging.basicConfig(level=loglevel)
     if config is not None:
         with open(config) as f:
@@ -17,7 +22,37 @@ def main(config, loglevel, **kwargs):
     else:
         conf_data = dict()
     config = {**conf_data, **kwargs}
-    Runner(config['runner']).run()
+    ctx.obj = dict(config=config, profile=profile)
+    if ctx.invoked_subcommand is None:
+        # the heavy dependencies (pandas, ...) are only imported if something is actually run
+        from tripper.exec import Runner
+
+        runner = Runner(config['runner'])
+        _run(runner.check if check else runner.run, profile)
+
+
+@main.command()
+@click.pass_obj
+def daemon(obj):
+    """
+    Keep running and download new episodes as soon as they are published
+    """
+    from tripper.exec import Daemon, Runner
+
+    conf = obj['config']['runner']
+    _run(Daemon(Runner(conf), **conf.get('daemon', dict())).run, obj['profile'])
+
+
+def _run(fn, profile):
+    if profile is None:
+        fn()
+    else:
+        profiler = cProfile.Profile()
+        try:
+            profiler.runcall(fn)
+        finally:
+            profiler.dump_stats(profile)
+            logging.info(f'Stored profile in {profile}')
 
 
 if __name__ == '__main__':
@@ -1,4 +1,5 @@
 from .mediathek import MediathekWrapper
 from .metadata import WikipediaWrapper
+from .store import TableStore
 
-__all__ = ['MediathekWrapper', 'WikipediaWrapper']
+__all__ = ['MediathekWrapper', 'WikipediaWrapper', 'TableStore']
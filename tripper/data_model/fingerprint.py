@@ -0,0 +1,184 @@
+import hashlib
+import logging
+import sqlite3
+import time
+from pathlib import Path
+from threading import Lock
+from typing import Iterable, List, Optional
+
+from tripper.util.http import session
+from tripper.util.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+DAY = 24 * 60 * 60
+
+
+def fingerprint(size: int, samples: List[bytes]) -> str:
+    return hashlib.sha1(str(size).encode() + b''.join(samples)).hexdigest()
+
+
+def sample_ranges(size: int, sample_bytes: int) -> List[range]:
+    """
+    :return: the byte ranges of the first and the last sample_bytes, they never overlap
+    """
+    ranges = [range(0, min(size, sample_bytes))]
+    if size > sample_bytes:
+        ranges.append(range(max(sample_bytes, size - sample_bytes), size))
+    return ranges
+
+
+class FingerprintIndex:
+    """
+    Persistent index of content fingerprints (exact size + sha1 of the first and last sample_bytes)
+    of the local files and the remote downloads, to find identical movies published under different urls.
+
+    Fingerprints are computed lazily: the sizes are always known (stat and HEAD requests),
+    the samples are only hashed (read or fetched with range requests) if another file has the same size.
+    Directories are only rescanned if their mtime changed.
+    """
+
+    def __init__(self, path: Path, dirs: Iterable[str], sample_bytes: int = 2 ** 20, ttl_days: float = 14,
+                 timeout: float = 30):
+        """
+        :param dirs: the directories of the local files
+        :param sample_bytes: size of the samples at the start and the end of a file
+        :param ttl_days: how long the fingerprints of remote urls are cached
+        """
+        self.dirs = [str(Path(dir_)) for dir_ in dirs]
+        self.sample_bytes = sample_bytes
+        self.ttl = ttl_days * DAY
+        self.timeout = timeout
+
+        self._lock = Lock()
+        self._con = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._con.execute('PRAGMA journal_mode=WAL')
+        self._con.execute('CREATE TABLE IF NOT EXISTS dirs (dir TEXT PRIMARY KEY, mtime REAL)')
+        self._con.execute('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, dir TEXT, size INTEGER,'
+                          ' mtime REAL, fingerprint TEXT)')
+        self._con.execute('CREATE INDEX IF NOT EXISTS files_size ON files (size)')
+        # size is NULL if the server does not support range requests
+        self._con.execute('CREATE TABLE IF NOT EXISTS remotes (url TEXT PRIMARY KEY, size INTEGER,'
+                          ' fingerprint TEXT, timestamp REAL)')
+        self._con.execute('DELETE FROM remotes WHERE timestamp < ?', (time.time() - self.ttl,))
+
+    def refresh(self):
+        """
+        update the local files, has to be called before the index is used
+        """
+        for dir_ in self.dirs:
+            try:
+                mtime = Path(dir_).stat().st_mtime
+            except FileNotFoundError:
+                mtime = None
+            with self._lock:
+                row = self._con.execute('SELECT mtime FROM dirs WHERE dir = ?', (dir_,)).fetchone()
+                if row is not None and row[0] == mtime:
+                    continue
+                known = {path: (size, mtime_) for path, size, mtime_ in self._con.execute(
+                    'SELECT path, size, mtime FROM files WHERE dir = ?', (dir_,))}
+
+            files = dict()
+            if mtime is not None:
+                logger.info(f'Scanning {dir_} for fingerprints')
+                for p in Path(dir_).glob('*.mp4'):
+                    stat = p.stat()
+                    files[str(p)] = (stat.st_size, stat.st_mtime)
+            with self._lock:
+                self._con.execute('BEGIN')
+                for path in set(known) - set(files):
+                    self._con.execute('DELETE FROM files WHERE path = ?', (path,))
+                for path, (size, mtime_) in files.items():
+                    if known.get(path) != (size, mtime_):
+                        # the file is new or changed, its fingerprint is computed again once it is needed
+                        self._con.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, NULL)',
+                                          (path, dir_, size, mtime_))
+                self._con.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?)', (dir_, mtime))
+                self._con.execute('COMMIT')
+
+    def find_local(self, size: int, fingerprint_: str) -> Optional[Path]:
+        """
+        :return: a local file with the given content, if there is any
+        """
+        with self._lock:
+            rows = self._con.execute('SELECT path, fingerprint FROM files WHERE size = ?', (size,)).fetchall()
+        for path, known in rows:
+            if known is None:
+                known = self.local_fingerprint(Path(path))
+            if known == fingerprint_:
+                return Path(path)
+        return None
+
+    def has_size(self, size: int) -> bool:
+        with self._lock:
+            return self._con.execute('SELECT 1 FROM files WHERE size = ?', (size,)).fetchone() is not None
+
+    def local_fingerprint(self, path: Path) -> Optional[str]:
+        try:
+            with open(path, 'rb') as f:
+                size = f.seek(0, 2)
+                samples = []
+                for r in sample_ranges(size, self.sample_bytes):
+                    f.seek(r.start)
+                    samples.append(f.read(len(r)))
+        except OSError:
+            return None
+        result = fingerprint(size, samples)
+        with self._lock:
+            self._con.execute('UPDATE files SET fingerprint = ? WHERE path = ? AND size = ?',
+                              (result, str(path), size))
+        metrics.inc('fingerprints', kind='local')
+        return result
+
+    def remote_size(self, url: str) -> Optional[int]:
+        """
+        :return: the exact size of the download, None if the server does not support range requests
+        """
+        with self._lock:
+            row = self._con.execute('SELECT size FROM remotes WHERE url = ?', (url,)).fetchone()
+        if row is not None:
+            return row[0]
+
+        res = session().head(url, allow_redirects=True, timeout=self.timeout)
+        res.raise_for_status()
+        size = None
+        if res.headers.get('Accept-Ranges', '').lower() == 'bytes' and 'Content-Length' in res.headers:
+            size = int(res.headers['Content-Length'])
+        with self._lock:
+            self._con.execute('INSERT OR REPLACE INTO remotes VALUES (?, ?, NULL, ?)', (url, size, time.time()))
+        return size
+
+    def remote_fingerprint(self, url: str) -> Optional[str]:
+        """
+        fetch the samples with range requests
+
+        :return: None if the server does not support range requests
+        """
+        size = self.remote_size(url)
+        if not size:
+            return None
+        with self._lock:
+            row = self._con.execute('SELECT fingerprint FROM remotes WHERE url = ?', (url,)).fetchone()
+        if row is not None and row[0] is not None:
+            return row[0]
+
+        samples = []
+        for r in sample_ranges(size, self.sample_bytes):
+            res = session().get(url, headers=dict(Range=f'bytes={r.start}-{r.stop - 1}'), timeout=self.timeout)
+            res.raise_for_status()
+            if res.status_code != 206 or len(res.content) != len(r):
+                return None
+            samples.append(res.content)
+        result = fingerprint(size, samples)
+        with self._lock:
+            self._con.execute('UPDATE remotes SET fingerprint = ? WHERE url = ?', (result, url))
+        metrics.inc('fingerprints', kind='remote')
+        return result
+
+    def close(self):
+        with self._lock:
+            self._con.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._con.execute('SELECT COUNT(*) FROM files').fetchone()[0]
@@ -0,0 +1,108 @@
+import re
+from collections import defaultdict
+from functools import partial
+from typing import Dict, Iterable, List, Set, Tuple
+
+import pandas as pd
+from rapidfuzz import fuzz, process
+from thefuzz import utils
+
+BRACKET_SUFFIX = re.compile(r' ?\([\d\D]*\)$')
+
+# thefuzz preprocesses the choices with full_process(force_ascii=True) before handing them to rapidfuzz,
+# the query is additionally passed through full_process() beforehand.
+# we replicate this here, so that the scores are identical to thefuzz.process.extract
+choice_key = partial(utils.full_process, force_ascii=True)
+
+
+def query_key(s: str) -> str:
+    return choice_key(utils.full_process(s))
+
+
+def strip_brackets(title: str) -> str:
+    return BRACKET_SUFFIX.sub('', title)
+
+
+def ngrams(s: str, n: int = 3) -> Set[str]:
+    if len(s) <= n:
+        return {s} if s else set()
+    return {s[i:i + n] for i in range(len(s) - n + 1)}
+
+
+class TitleIndex:
+    """
+    Matching index over the episode titles. It is built once per episodes table and
+    allows to resolve titles without scanning all episodes for every query.
+    """
+
+    def __init__(self, episodes: pd.DataFrame, shortlist_size: int = 64):
+        self.shortlist_size = shortlist_size
+
+        # title -> ids (in order of the episodes table)
+        self.ids_by_title: Dict[str, List[int]] = defaultdict(list)
+        # bracket stripped title -> ids
+        self.ids_by_stripped: Dict[str, List[int]] = defaultdict(list)
+        for id_, title in episodes.title.items():
+            self.ids_by_title[title].append(id_)
+            self.ids_by_stripped[strip_brackets(title)].append(id_)
+        self.ids_by_title = dict(self.ids_by_title)
+        self.ids_by_stripped = dict(self.ids_by_stripped)
+
+        # bag of words of the metadata (year, team, city) for the disambiguation by description
+        self.bags: Dict[int, Set[str]] = episodes.meta_data.to_dict()
+
+        self.choices: List[str] = list(self.ids_by_title)
+        self.keys: List[str] = [choice_key(title) for title in self.choices]
+        self.key_ngrams: List[int] = []
+        self.postings: Dict[str, List[int]] = defaultdict(list)
+        for i, key in enumerate(self.keys):
+            grams = ngrams(key)
+            self.key_ngrams.append(len(grams))
+            for gram in grams:
+                self.postings[gram].append(i)
+        self.postings = dict(self.postings)
+
+    def __contains__(self, title) -> bool:
+        return title in self.ids_by_title
+
+    def __len__(self):
+        return len(self.choices)
+
+    def shortlist(self, key: str) -> List[int]:
+        """
+        Blocking step: rank the titles by their character trigram overlap (dice coefficient) with the query
+
+        :return: indices into self.choices
+        """
+        grams = ngrams(key)
+        shared = defaultdict(int)
+        for gram in grams:
+            for i in self.postings.get(gram, ()):
+                shared[i] += 1
+        ranked = sorted(shared, key=lambda i: 2 * shared[i] / (len(grams) + self.key_ngrams[i]), reverse=True)
+        return ranked[:self.shortlist_size]
+
+    def extract(self, title: str, score_cutoff: float = 0, limit: int = 5) -> List[Tuple[str, int]]:
+        """
+        Equivalent to sorted(thefuzz.process.extract(title, set(titles)), key=itemgetter(1), reverse=True).
+
+        Only the shortlisted titles are scored. If none of them exceeds the score_cutoff,
+        the result depends on the complete ranking and all titles are scored.
+        """
+        key = query_key(title)
+        candidates = self.shortlist(key)
+        if candidates:
+            matches = self._score(key, candidates, limit)
+            if matches[0][1] > score_cutoff:
+                return matches
+        return self._score(key, range(len(self.choices)), limit)
+
+    def _score(self, key: str, candidates: Iterable[int], limit: int) -> List[Tuple[str, int]]:
+        results = process.extract(key, {i: self.keys[i] for i in candidates},
+                                  scorer=fuzz.WRatio, processor=None, limit=limit)
+        return sorted([(self.choices[i], int(round(score))) for _, score, i in results],
+                      key=lambda x: x[1], reverse=True)
+
+    def recall(self, tatort_id: int, description_bag: Set[str]) -> float:
+        bag_of_words = self.bags[tatort_id]
+        return len(bag_of_words & description_bag) / (len(bag_of_words) + 1e-10)
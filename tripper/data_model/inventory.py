@@ -0,0 +1,179 @@
+import json
+import logging
+import os
+import re
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from shutil import which
+from subprocess import check_output, CalledProcessError, TimeoutExpired
+from threading import Lock
+from typing import Dict, Iterable, List, NamedTuple, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class InventoryEntry(NamedTuple):
+    tid: int
+    path: str
+    size: int
+    mtime: float
+    duration: Optional[float] = None
+    bit_rate: Optional[float] = None
+    height: Optional[int] = None
+    # the file was checked completely after its download
+    verified: bool = False
+
+    @property
+    def probed(self):
+        return self.bit_rate is not None
+
+
+class CollectionInventory:
+    """
+    Persistent inventory of the local collection (tatort id -> files).
+
+    Directories are only rescanned if their mtime changed, files are only re-stat'ed in rescanned directories.
+    The bit rate and resolution of the files are probed lazily and kept until the file changes.
+    """
+    VERSION = 1
+
+    def __init__(self, path: Path, dirs: Iterable[str], timeout: float = 60):
+        self.path = Path(path)
+        self.timeout = timeout
+        self.can_probe = which('ffprobe') is not None
+        self._dirs: Dict[str, float] = dict()
+        self._files: Dict[str, InventoryEntry] = dict()
+        self._changed = False
+        self._by_tid = None
+        self._lock = Lock()
+        self._load()
+        self.refresh(dirs)
+
+    def _load(self):
+        if not self.path.exists():
+            return
+        try:
+            state = json.loads(self.path.read_text())
+        except ValueError:
+            logger.warning(f'Ignoring corrupt inventory {self.path}')
+            return
+        if state.get('version') != self.VERSION:
+            return
+        self._dirs = state['dirs']
+        self._files = {path: InventoryEntry(**entry) for path, entry in state['files'].items()}
+
+    def save(self):
+        self._by_tid = None
+        if not self._changed:
+            return
+        tmp = self.path.with_name(self.path.name + '.tmp')
+        tmp.write_text(json.dumps(dict(version=self.VERSION, dirs=self._dirs,
+                                       files={path: entry._asdict() for path, entry in self._files.items()})))
+        os.replace(tmp, self.path)
+        self._changed = False
+
+    def refresh(self, dirs: Iterable[str]):
+        dirs = [str(Path(dir_)) for dir_ in dirs]
+        for dir_ in set(self._dirs) - set(dirs):
+            self._drop_dir(dir_)
+
+        for dir_ in dirs:
+            try:
+                mtime = Path(dir_).stat().st_mtime
+            except FileNotFoundError:
+                self._drop_dir(dir_)
+                continue
+            if self._dirs.get(dir_) == mtime:
+                continue
+
+            logger.info(f'Scanning {dir_} for changes')
+            files = dict()
+            for p in Path(dir_).glob('*.mp4'):
+                match = re.match(r'(\d+)', p.name)
+                if match is None:
+                    continue
+                stat = p.stat()
+                known = self._files.get(str(p))
+                if known is not None and known.size == stat.st_size and known.mtime == stat.st_mtime:
+                    files[str(p)] = known
+                else:
+                    files[str(p)] = InventoryEntry(int(match[0]), str(p), stat.st_size, stat.st_mtime)
+            self._drop_dir(dir_)
+            self._files.update(files)
+            self._dirs[dir_] = mtime
+            self._changed = True
+        self.save()
+
+    def record(self, path: Path, duration: float, bit_rate: float, height: Optional[int] = None):
+        """
+        store the metadata of a verified download, so that it is neither probed nor rescanned later.
+        Files outside of the inventory directories are ignored
+        """
+        match = re.match(r'(\d+)', path.name)
+        if match is None or str(path.parent) not in self._dirs:
+            return
+        stat = path.stat()
+        with self._lock:
+            self._files[str(path)] = InventoryEntry(int(match[0]), str(path), stat.st_size, stat.st_mtime,
+                                                    duration, bit_rate, height, verified=True)
+            self._changed = True
+            self.save()
+
+    def _drop_dir(self, dir_: str):
+        if self._dirs.pop(dir_, None) is not None:
+            self._changed = True
+        for path in [path for path in self._files if str(Path(path).parent) == dir_]:
+            del self._files[path]
+            self._changed = True
+
+    def by_tid(self) -> Dict[int, List[InventoryEntry]]:
+        """
+        :return: tatort id -> files sorted by size (largest first)
+        """
+        if self._by_tid is None:
+            result = defaultdict(list)
+            for entry in self._files.values():
+                result[entry.tid].append(entry)
+            self._by_tid = {tid: sorted(entries, key=lambda e: e.size, reverse=True)
+                            for tid, entries in result.items()}
+        return self._by_tid
+
+    def best(self, tid: int) -> Optional[InventoryEntry]:
+        entries = self.by_tid().get(tid)
+        return entries[0] if entries else None
+
+    def sizes(self) -> Dict[int, int]:
+        return {tid: entries[0].size for tid, entries in self.by_tid().items()}
+
+    def duplicates(self) -> Dict[int, List[str]]:
+        return {tid: [e.path for e in entries] for tid, entries in self.by_tid().items() if len(entries) > 1}
+
+    def probe_many(self, tids: Iterable[int], workers: int = 8):
+        """
+        probe bit rate and resolution of the (largest) files of the given tatort ids, if not known already
+        """
+        if not self.can_probe:
+            return
+        by_tid = self.by_tid()
+        entries = [by_tid[tid][0] for tid in set(tids) if tid in by_tid and not by_tid[tid][0].probed]
+        if not entries:
+            return
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for entry in executor.map(self._probe, entries):
+                self._files[entry.path] = entry
+        self._changed = True
+        self.save()
+
+    def _probe(self, entry: InventoryEntry) -> InventoryEntry:
+        try:
+            info = json.loads(check_output(
+                ['ffprobe', entry.path, '-v', 'quiet', '-select_streams', 'v:0', '-of', 'json',
+                 '-show_entries', 'format=duration,bit_rate:stream=height'], timeout=self.timeout))
+            format_ = info.get('format', {})
+            streams = info.get('streams') or [{}]
+            return entry._replace(duration=float(format_['duration']), bit_rate=float(format_['bit_rate']),
+                                  height=streams[0].get('height'))
+        except (CalledProcessError, TimeoutExpired, ValueError, KeyError):
+            logger.warning(f'Could not probe {entry.path}')
+            return entry
@@ -0,0 +1,108 @@
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain
+from typing import List, Optional, Sequence, Tuple
+
+from tripper.data_model.index import TitleIndex, strip_brackets
+from tripper.util.metrics import metrics
+from tripper.util.string import to_bag_of_words
+
+
+class TitleMatcher:
+    """
+    Resolves a mediathek title and description to tatort ids
+    """
+
+    def __init__(self, index: TitleIndex, title_thresh: float, desc_thresh: float):
+        self.index = index
+        self.title_thresh = title_thresh
+        self.desc_thresh = desc_thresh
+
+    def predict(self, title: str, descr: str) -> List[int]:
+        if title in self.index:
+            # title is an exact match
+            title_candidates = [title]
+        else:
+            # we use fuzzy matching as a fallback
+            title_candidates = self.select_title_candidates(self.index.extract(title, score_cutoff=self.title_thresh))
+        return self.resolve_title_candidates(title_candidates, descr)
+
+    def select_title_candidates(self, fuzzy_matches: List[Tuple[str, int]]) -> List[str]:
+        title_candidates = []
+        first_score = fuzzy_matches[0][1]
+        for i, (title_, score) in enumerate(fuzzy_matches):
+            if score > self.title_thresh or score == first_score:
+                # take the first of the list and all others that have a higher score than the threshold
+                # if two titles only differ by writings in brackets (like "Teil 1", "Teil 2") than the most likely one is used
+                # this is a heuristic that will probably select the one with the correct version number
+                # this heuristic is only applied when the scores differ!
+                if i == 0 or \
+                        not (strip_brackets(title_) == strip_brackets(title_candidates[0])
+                             and score != first_score):
+                    title_candidates.append(title_)
+            else:
+                # the list is sorted, so we can break if the score no longer exceeds the threshold
+                break
+        return title_candidates
+
+    def resolve_title_candidates(self, title_candidates: List[str], descr) -> List[int]:
+        if len(title_candidates) == 1 and len(self.index.ids_by_title[title_candidates[0]]) == 1:
+            return [self.index.ids_by_title[title_candidates[0]][0]]
+
+        # several titles or a title of several episodes are disambiguated by the description
+        title_candidates = Counter(map(strip_brackets, title_candidates))
+        description_bag = to_bag_of_words([descr])
+        id_candidates = []
+        for title_ in title_candidates:
+            ids = self.index.ids_by_stripped[title_]
+            if len(ids) == 1:
+                # if the title unique
+                id_candidates.append(ids[0])
+            else:
+                # try to use description to disambiguate
+                # if team in description of only one match -> surely correct
+                for id_ in ids:
+                    if self.index.recall(id_, description_bag) * 100 > self.desc_thresh:
+                        id_candidates.append(id_)
+
+        return id_candidates
+
+    def predict_many(self, rows: Sequence[Tuple[str, str]], workers: int = 1, chunk_size: int = 64) \
+            -> List[List[int]]:
+        """
+        predict the ids of many (title, description) rows. If there are more rows than a single chunk,
+        the chunks are distributed over a pool of worker processes, which receive the matcher only once.
+
+        :return: the predictions in the order of the rows
+        """
+        if workers <= 1 or len(rows) <= chunk_size:
+            timed = [self._timed_predict(title, descr) for title, descr in rows]
+        else:
+            chunks = [rows[i:i + chunk_size] for i in range(0, len(rows), chunk_size)]
+            with ProcessPoolExecutor(max_workers=min(workers, len(chunks)), initializer=_init_worker,
+                                     initargs=(self,)) as executor:
+                timed = list(chain.from_iterable(executor.map(_predict_chunk, chunks)))
+
+        # the workers have their own metrics, hence the durations are recorded here
+        for _, seconds in timed:
+            metrics.observe('match_row', seconds)
+        return [ids for ids, _ in timed]
+
+    def _timed_predict(self, title: str, descr: str) -> Tuple[List[int], float]:
+        start = time.perf_counter()
+        ids = self.predict(title, descr)
+        return ids, time.perf_counter() - start
+
+
+# the matcher of a worker process
+_matcher: Optional[TitleMatcher] = None
+
+
+def _init_worker(matcher: TitleMatcher):
+    global _matcher
+    _matcher = matcher
+
+
+def _predict_chunk(rows: Sequence[Tuple[str, str]]) -> List[Tuple[List[int], float]]:
+    return [_matcher._timed_predict(title, descr) for title, descr in rows]
@@ -1,85 +1,283 @@
+import hashlib
 import json
 import logging
+import re
+import time
 from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 
 import pandas as pd
-import requests
 
-from tripper.util.path import older
+from tripper.data_model.store import TableStore
+from tripper.util.http import HttpCache, session
+from tripper.util.metrics import metrics
+from tripper.util.stream import iter_json_array
 
 logger = logging.getLogger(__name__)
 
+QUERY_URL = 'https://mediathekviewweb.de/api/query'
+COLUMNS = ['title', 'description', 'url', 'url_subtitle', 'timestamp']
+DAY = 24 * 60 * 60
+
+# can be overwritten by the mediathek.rules in the config
+DEFAULT_RULES = dict(
+    include=dict(topic=['Tatort'], title=['Tatort']),
+    exclude=dict(
+        topic=['AD | Tatort', 'Audiodeskription', 'Einstein', 'DOK', 'Doku', 'Polizeiruf 110'],
+        title=['Polizeiruf 110', 'Hörfassung', 'Audiodeskription', 'klare Sprache', 'Klare Sprache', r'\(AD\)$',
+               r'^AD \| ', 'Gebärdensprache'],
+        url=['hallohessen']),
+    title_cleanup=[
+        ('^Tatort: ', ''),
+        ('^Tatort (-|–) ', ''),
+        (r' \| tatort$', ''),
+        (r' ?\(ab \d+ Jahre\)$', ''),
+        (r' ?\(FSK \d+\)$', ''),
+        (r'^«(?P<x>[\w\s]*)» – [\S\s]*$', r'\g<x>'),
+    ])
+
 
 class MediathekWrapper:
-    def __init__(self, cache_dir: str, mediathek_query_size: int):
+    # increase whenever the processing of the mediathek data changes, to invalidate the caches
+    CACHE_VERSION = 1
+
+    def __init__(self, cache_dir: str, mediathek_query_size: int, incremental: bool = False, page_size: int = 250,
+                 offline: bool = False, rules: Optional[dict] = None, full_sync_days: float = 7):
+        """
+        :param cache_dir:
+        :param mediathek_query_size: maximum number of results queried from mediathekview
+        :param incremental: only query the results that are new since the last sync and merge them into the cache
+        :param page_size: number of results per request in the incremental mode
+        :param offline: only use the cached results, regardless of their age
+        :param rules: include, exclude and title_cleanup rules, see ResultFilter
+        :param full_sync_days: interval of the full syncs in the incremental mode, they remove the expired entries
+        """
         self.cache_dir = Path(cache_dir)
         self.mediathek_query_size = mediathek_query_size
-        self.mediathek = self._get_mediathek()
+        self.incremental = incremental
+        self.page_size = page_size
+        self.full_sync_days = full_sync_days
+        self.offline = offline
+        self.result_filter = ResultFilter(**(rules or dict()))
+        # the cached tables are filtered, hence they are invalidated whenever the rules change
+        self.cache_version = f'{self.CACHE_VERSION}-{self.result_filter.fingerprint}'
+        # entries that are new since the last sync (all entries if not in incremental mode)
+        self.new = None
+        self.mediathek = None
+        self.refresh()
+
+    def refresh(self):
+        """
+        query mediathekview again (or use the cache if it is still valid)
+        """
+        self.new = None
+        if self.offline:
+            self.mediathek = self._get_cached_mediathek()
+        else:
+            self.mediathek = self._sync_mediathek() if self.incremental else self._get_mediathek()
+        if self.new is None:
+            self.new = self.mediathek
+
+    @staticmethod
+    def _query_data(offset: int, size: int) -> str:
+        return json.dumps({"queries": [{
+            "fields": ["topic", "title"],
+            "query": "tatort"}],
+            "sortBy": "timestamp", "sortOrder": "desc", "offset": offset, 'future': True,
+            "size": size,
+            'duration_min': 55 * 60, 'duration_max': 105 * 60})
+
+    def _query(self, offset: int, size: int) -> Iterator[dict]:
+        """
+        :return: the results, decoded incrementally while the response is streamed
+        """
+        # the body is streamed, hence the timer covers reading and decoding it (and the filtering of the caller)
+        with metrics.timer('mediathek_fetch'):
+            res = session().post(QUERY_URL, headers={'Content-Type': 'text/plain'},
+                                 data=self._query_data(offset, size), stream=True, timeout=60)
+            res.raise_for_status()
+            with res:
+                yield from iter_json_array(res.iter_content(chunk_size=1 << 16), 'results')
 
     def _get_mediathek(self):
-        path = self.cache_dir / 'mediathek.csv'
-
-        if not path.exists() or older(path, days=1):
-            logger.info('Downloading data from mediathekview')
-            res = requests.post('https://mediathekviewweb.de/api/query',
-                                headers={'Content-Type': 'text/plain'},
-                                data=json.dumps({"queries": [{
-                                    "fields": ["topic", "title"],
-                                    "query": "tatort"}],
-                                    "sortBy": "timestamp", "sortOrder": "desc", "offset": 0, 'future': True,
-                                    "size": self.mediathek_query_size,
-                                    'duration_min': 55 * 60, 'duration_max': 105 * 60}))
-
-            df = pd.json_normalize(res.json()['result']['results'])
-
-            logger.info('Processed data from mediathekview')
-            mediathek = (
-                df.set_index('id')
-                .assign(url=lambda df_: df_.url_video_hd.replace('', pd.NA).fillna(df_.url_video))
-                .drop(columns=['url_video', 'url_video_low', 'url_video_hd', 'url_website', 'filmlisteTimestamp'])
-                # the sorting is important, so that ARD is always favoured when dropping duplicate (A is the first character)
-                .sort_values(["channel"])
-                .drop(columns=['channel', 'duration'])
-                .drop_duplicates(subset='url')
-                .query(
-                    "(topic.str.contains('Tatort') or title.str.contains('Tatort'))"
-                    " and not topic.str.contains('AD | Tatort')"
-                    " and not topic.str.contains('Audiodeskription')"
-                    " and not topic.str.contains('Einstein')"
-                    " and not topic.str.contains('DOK')"
-                    " and not topic.str.contains('Doku')"
-                    " and not topic.str.contains('Polizeiruf 110')"
-                    " and not title.str.contains('Polizeiruf 110')"
-                    " and not title.str.contains('Hörfassung')"
-                    " and not title.str.contains('Audiodeskription')"
-                    " and not title.str.contains('klare Sprache')"
-                    " and not title.str.contains('Klare Sprache')"
-                    " and not title.str.endswith('(AD)')"
-                    " and not title.str.startswith('AD | ')"
-                    " and not title.str.contains('Gebärdensprache')"
-                    " and not url.str.contains('hallohessen')",
-                    engine="python")
-                .assign(title=lambda df: df.title.str.replace("^Tatort: ", "", regex=True)
-                        .replace("^Tatort (-|–) ", "", regex=True)
-                        .replace(" \| tatort$", "", regex=True)
-                        .replace(" ?\(ab \d+ Jahre\)$", "", regex=True)
-                        .replace(" ?\(FSK \d+\)$", "", regex=True)
-                        # .replace(" ?\(\d+\)$", "", regex=True)
-                        .replace("^«(?P<x>[\w\s]*)» – [\S\s]*$", "\g<x>", regex=True)
-                        )
-                [['title', 'description', 'url', 'url_subtitle', 'timestamp']]
-            )
-
-            mediathek.to_csv(path)  # noqa
+        store = TableStore(self.cache_dir / 'mediathek', version=self.cache_version)
+        mediathek = store.read(max_age_days=1)
+
+        if mediathek is None:
+            # the body is streamed while it is parsed, hence mediathek_fetch includes mediathek_parse
+            with metrics.timer('mediathek_fetch'):
+                response = HttpCache(self.cache_dir).request(
+                    'mediathek', QUERY_URL, method='POST', headers={'Content-Type': 'text/plain'},
+                    data=self._query_data(0, self.mediathek_query_size))
+                mediathek = None if response.changed else store.read()
+                if mediathek is None:
+                    logger.info('Downloading and processing data from mediathekview')
+                    with metrics.timer('mediathek_parse'):
+                        mediathek = self._process(iter_json_array(response.iter_content(), 'results'),
+                                                  self.result_filter)
+                else:
+                    logger.info('The mediathekview data did not change')
+            # the rewrite also resets the age of the cache
+            store.write(mediathek)
         else:
             logger.info('Using cached mediathekview data')
-            mediathek = pd.read_csv(path)
 
         return mediathek
 
+    def _get_cached_mediathek(self):
+        mediathek = TableStore(self.cache_dir / ('mediathek_sync' if self.incremental else 'mediathek'),
+                               version=self.cache_version).read()
+        if mediathek is None:
+            raise FileNotFoundError(f'No cached mediathekview data in {self.cache_dir}')
+        return mediathek
+
+    def _sync_mediathek(self):
+        """
+        Incremental sync: page through the newest results until a page of already known entries is reached
+        and upsert the new entries into the cached table.
+
+        Expired entries disappear from mediathekview without a trace in the newest results, hence a full sync
+        replaces the cached table every full_sync_days.
+        """
+        store = TableStore(self.cache_dir / 'mediathek_sync', version=self.cache_version)
+        state_path = self.cache_dir / 'mediathek_sync.json'
+
+        stored = store.read()
+        if stored is not None and state_path.exists():
+            state = json.loads(state_path.read_text())
+        else:
+            stored = None
+            state = dict(timestamp=0, filmlisteTimestamp=0, ids=[])
+        now = time.time()
+        full = now - state.get('full_sync', 0) > self.full_sync_days * DAY
+        if full:
+            state = dict(timestamp=0, filmlisteTimestamp=0, ids=[])
+        known_ids = set(state['ids'])
+
+        logger.info(f'Synchronizing data from mediathekview{" (full sync)" if full else ""}')
+        rows = []
+        new_state = dict(state, full_sync=now if full else state.get('full_sync', 0))
+        offset = 0
+        while offset < self.mediathek_query_size:
+            results = list(self._query(offset, min(self.page_size, self.mediathek_query_size - offset)))
+            page = [r for r in results if r['id'] not in known_ids]
+            if page:
+                new_state = dict(
+                    new_state,
+                    # the future broadcasts are listed first, they must not move the last sync into the future
+                    timestamp=max(new_state['timestamp'], *(min(int(r['timestamp']), now) for r in page)),
+                    filmlisteTimestamp=max(new_state['filmlisteTimestamp'],
+                                           *(int(r['filmlisteTimestamp']) for r in page)),
+                    # the ids are only needed to detect the overlap with the last sync
+                    ids=(new_state['ids'] + [r['id'] for r in page])[-10 * self.mediathek_query_size:])
+            with metrics.timer('mediathek_parse'):
+                # only the surviving results of every page are kept
+                rows.extend(filter(None, map(self.result_filter, page)))
+            offset += len(results)
+            # known future broadcasts are at the top of every sync, only the past ones tell where the last sync ended
+            past = [r for r in results if int(r['timestamp']) <= now]
+            if len(results) < self.page_size or past and (
+                    all(r['id'] in known_ids for r in past) or all(r['timestamp'] < state['timestamp'] for r in past)):
+                # reached a page of entries that are already known
+                break
+
+        state = new_state
+        with metrics.timer('mediathek_parse'):
+            new = self._frame(rows)
+
+        if stored is not None:
+            if full:
+                # the entries that are not listed anymore are expired
+                mediathek = new
+                logger.info(f'Removed {(~stored.url.isin(new.url)).sum()} expired entries')
+            else:
+                # upsert: the new entries replace stored entries with the same id or url
+                mediathek = pd.concat([new, stored[~stored.index.isin(new.index)]]).drop_duplicates(subset='url')
+            new = new[~new.url.isin(stored.url)]
+        else:
+            mediathek = new
+        self.new = new
+        logger.info(f'{len(new)} new entries since the last sync ({len(mediathek)} entries in total)')
+
+        store.write(mediathek)
+        state_path.write_text(json.dumps(state))
+        return mediathek
+
+    @staticmethod
+    def _process(results: Iterable[dict], result_filter: Optional['ResultFilter'] = None) -> pd.DataFrame:
+        """
+        :param results: mediathekview results, they are filtered one by one, so only the surviving rows are kept
+        """
+        return MediathekWrapper._frame(filter(None, map(result_filter or ResultFilter(), results)))
+
+    @staticmethod
+    def _frame(rows: Iterable[tuple]) -> pd.DataFrame:
+        return (
+            pd.DataFrame.from_records(list(rows), columns=['id', 'channel'] + COLUMNS)
+            .set_index('id')
+            # the sorting is important, so that ARD is always favoured when dropping duplicate (A is the first character)
+            .sort_values(["channel"])
+            .drop_duplicates(subset='url')
+            [COLUMNS]
+        )
+
     def __iter__(self):
         for index, row in self.mediathek.iterrows():
             yield row
 
     def __len__(self):
         return len(self.mediathek.index)
+
+
+class ResultFilter:
+    """
+    The exclusion rules and title cleanups compiled to predicates that are applied to single mediathekview results
+    """
+
+    def __init__(self, include: Optional[Dict[str, List[str]]] = None,
+                 exclude: Optional[Dict[str, List[str]]] = None,
+                 title_cleanup: Optional[List[Tuple[str, str]]] = None):
+        """
+        the rules default to DEFAULT_RULES, all patterns are regular expressions searched in the field
+
+        :param include: field -> patterns. A result is kept if any of the patterns matches
+        :param exclude: field -> patterns. A result is dropped if any of the patterns matches
+        :param title_cleanup: (pattern, replacement) substitutions applied to the title of the kept results
+        """
+
+        # the effective rules
+        self.rules = dict(include=DEFAULT_RULES['include'] if include is None else include,
+                          exclude=DEFAULT_RULES['exclude'] if exclude is None else exclude,
+                          title_cleanup=DEFAULT_RULES['title_cleanup'] if title_cleanup is None else title_cleanup)
+
+        def compile_(rules):
+            return [(field, re.compile('|'.join(f'(?:{pattern})' for pattern in patterns)))
+                    for field, patterns in rules.items() if patterns]
+
+        self.include = compile_(self.rules['include'])
+        self.exclude = compile_(self.rules['exclude'])
+        self.title_cleanup = [(re.compile(pattern), replacement)
+                              for pattern, replacement in self.rules['title_cleanup']]
+
+    @property
+    def fingerprint(self) -> str:
+        """
+        short hash of the effective rules
+        """
+        return hashlib.sha1(json.dumps(self.rules, sort_keys=True).encode()).hexdigest()[:8]
+
+    def __call__(self, result: dict) -> Optional[tuple]:
+        """
+        :return: the row (id, channel, title, description, url, url_subtitle, timestamp) or None if the result is dropped
+        """
+        fields = dict(result, url=result.get('url_video_hd') or result['url_video'])
+        if self.include and not any(pattern.search(fields.get(field) or '') for field, pattern in self.include):
+            return None
+        if any(pattern.search(fields.get(field) or '') for field, pattern in self.exclude):
+            return None
+
+        title = result['title']
+        for pattern, replacement in self.title_cleanup:
+            title = pattern.sub(replacement, title)
+        return (result['id'], result['channel'], title, result['description'], fields['url'], result['url_subtitle'],
+                result['timestamp'])
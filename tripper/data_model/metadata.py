@@ -1,77 +1,139 @@
 import logging
 import re
-from collections import Counter
-from functools import reduce
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from importlib import resources
-from operator import itemgetter, or_
+from io import StringIO
 from pathlib import Path
 from shutil import which
-from subprocess import check_output, CalledProcessError
+from subprocess import check_output, CalledProcessError, TimeoutExpired
 from typing import List, Optional, Tuple
 from urllib.error import HTTPError
 from urllib.request import urlopen
 
+import numpy as np
 import pandas as pd
-import requests
 import yaml
-from thefuzz import process
-
-from tripper.util.path import older
-from tripper.util.string import sort_and_simplify, to_bag_of_words
+from rapidfuzz import fuzz, process
+from tqdm import tqdm
+
+from tripper.data_model.index import TitleIndex, choice_key, query_key
+from tripper.data_model.inventory import CollectionInventory
+from tripper.data_model.matching import TitleMatcher
+from tripper.data_model.probe_cache import ProbeCache, ProbeResult
+from tripper.data_model.store import TableStore
+from tripper.util.http import HttpCache
+from tripper.util.metrics import metrics
+from tripper.util.string import sort_and_simplify
 
 logger = logging.getLogger(__name__)
 
+WIKI_URL = 'https://de.wikipedia.org/wiki/Liste_der_Tatort-Folgen'
+
 
 class WikipediaWrapper:
-    def __init__(self, cache_dir: str, final_tatortdirs: List[str], pred_thresholds: dict):
+    # increase whenever the processing of the wikipedia data changes, to invalidate the caches
+    CACHE_VERSION = 1
+
+    def __init__(self, cache_dir: str, final_tatortdirs: List[str], pred_thresholds: dict,
+                 probe: Optional[dict] = None, offline: bool = False, matching: Optional[dict] = None):
+        """
+        :param offline: only use the cached wikipedia data and probe results, regardless of their age.
+                        The local files are not probed
+        :param matching: workers (processes) and chunk_size of the fuzzy matching in predict_ids
+        """
         self.cache_dir = Path(cache_dir)
+        self.offline = offline
         self.title_thresh = pred_thresholds['title_thresh']
         self.desc_thresh = pred_thresholds['desc_thresh']
-        self.size_of_tatort = reduce(lambda d1, d2: {**d1, **d2},
-                                     [{int(re.match('(\d+)', p.name)[0]): p.stat().st_size for p in
-                                       Path(final_tatortdir).glob('*.mp4')} for final_tatortdir in
-                                      final_tatortdirs])
+        matching = matching or dict()
+        self.matching_workers = matching.get('workers', 1)
+        self.matching_chunk_size = matching.get('chunk_size', 64)
+        self.final_tatortdirs = final_tatortdirs
+        self.http = HttpCache(self.cache_dir)
+        self.inventory = CollectionInventory(self.cache_dir / 'inventory.json', final_tatortdirs)
+        self.size_of_tatort = self.inventory.sizes()
+        duplicates = self.inventory.duplicates()
+        if duplicates:
+            logger.warning(f'{len(duplicates)} episodes are stored multiple times: {sorted(duplicates)}')
         self.episodes = self._get_wiki_tatortlist()
-        self.filesize_estimator = FilesizeEstimator()
-
-    def _get_wiki_tatortlist(self):
-        path = self.cache_dir / 'episodes.pkl'
-
-        if not path.exists() or older(path, days=5):
-            logger.info('Downloading and processing wikipedia meta data')
-
-            req = requests.get('https://de.wikipedia.org/wiki/Liste_der_Tatort-Folgen')
-
-            teams_s = resources.read_text('tripper.resources', 'teams.yaml')
-            teams = {sort_and_simplify(team): city for team, city in yaml.safe_load(teams_s).items()}
-
-            def _predict_city(team):
-                value, prob = process.extractOne(sort_and_simplify(team), teams.keys())
-                return teams[value] + ('??' if prob < 80 else '?' if prob < 90 else '')
-
-            episodes = (
-                pd.read_html(req.text)[0]
-                .replace('\s', ' ', regex=True)
-                # remove the secondary table header: series "Folge" contains literal "Folge"
-                .query('Folge != "Folge"')
-                .rename(columns=dict(Folge='id', Titel='title', Ermittler='team', Erstausstrahlung='airing_date',
-                                     City='city', Besonderheiten='notes'))
-                .assign(city=lambda df: [_predict_city(team) for team in df.team])
-                .assign(id=lambda df: df.id.astype(int))
-                [['id', 'title', 'team', 'airing_date', 'city', 'notes']]
-                .assign(meta_data=lambda df:
-                df.apply(lambda row: to_bag_of_words(filter(lambda x: bool(x) and isinstance(x, str),
-                                                            [(re.search('(\d{4})', row.airing_date) or [
-                                                                ''])[0],
-                                                             row.team, row.city])), axis=1))
-            )
-            episodes.to_pickle(path)  # noqa
-        else:
+        self.index = TitleIndex(self.episodes)
+        self._matcher: Optional[TitleMatcher] = None
+        self.filesize_estimator = FilesizeEstimator(cache_path=self.cache_dir / 'probes.sqlite', offline=offline,
+                                                    **(probe or dict()))
+
+    def refresh(self, episodes: bool = False):
+        """
+        update the in-memory state of a long running process
+
+        :param episodes: also check the wikipedia list for changes and rebuild the title index if it changed
+        """
+        self.inventory.refresh(self.final_tatortdirs)
+        self.size_of_tatort = self.inventory.sizes()
+        if episodes:
+            updated = self._get_wiki_tatortlist(only_if_changed=True)
+            if updated is not None:
+                self.episodes = updated
+                self.index = TitleIndex(self.episodes)
+
+    def _get_wiki_tatortlist(self, only_if_changed: bool = False) -> Optional[pd.DataFrame]:
+        """
+        The wikipedia list is requested conditionally, it is only downloaded and parsed again if it changed.
+
+        :param only_if_changed: return None instead of the cached episodes if the list did not change
+        """
+        store = TableStore(self.cache_dir / 'episodes', version=self.CACHE_VERSION, fallback='pickle',
+                           set_columns=['meta_data'])
+        episodes = store.read()
+        if self.offline:
+            if episodes is None:
+                raise FileNotFoundError(f'No cached wikipedia data in {self.cache_dir}')
+            return episodes.set_index('id')
+
+        try:
+            with metrics.timer('wiki_fetch'):
+                response = self.http.request('wikipedia', WIKI_URL)
+                # the cached body is only read if the episodes have to be parsed again
+                html = response.content.decode('utf-8') if episodes is None or response.changed else None
+        except OSError as e:
+            # connection problems (the requests exceptions are OSErrors as well)
+            if episodes is None:
+                raise
+            logger.warning(f'Could not check the wikipedia list for changes, using the cached data: {e!r}')
+            return None if only_if_changed else episodes.set_index('id')
+
+        if html is None:
             logger.info('Using cached wikipedia meta data')
-            episodes = pd.read_pickle(path)
+            return None if only_if_changed else episodes.set_index('id')
 
+        logger.info('Processing wikipedia meta data')
+        with metrics.timer('wiki_parse'):
+            episodes = self._parse_wiki_tatortlist(html)
+        store.write(episodes)
         return episodes.set_index('id')
 
+    @staticmethod
+    def _parse_wiki_tatortlist(html: str) -> pd.DataFrame:
+        df = (
+            pd.read_html(StringIO(html))[0]
+            .replace('\s', ' ', regex=True)
+            # remove the secondary table header: series "Folge" contains literal "Folge"
+            .query('Folge != "Folge"')
+            .rename(columns=dict(Folge='id', Titel='title', Ermittler='team', Erstausstrahlung='airing_date',
+                                 City='city', Besonderheiten='notes'))
+            .assign(city=lambda df_: city_predictor()(df_.team))
+            .assign(id=lambda df_: df_.id.astype(int))
+            [['id', 'title', 'team', 'airing_date', 'city', 'notes']]
+        )
+        # bag of words (longer than 3 characters) of the year, the team and the city, as far as they are known
+        words = (pd.concat([df.airing_date.str.extract(r'(\d{4})', expand=False), df.team, df.city])
+                 .dropna().str.split().explode())
+        words = words[words.str.len() > 3]
+        return df.assign(meta_data=words.groupby(level=0).agg(set).reindex(df.index)
+                         .apply(lambda bag: bag if isinstance(bag, set) else set()))
+
     def __getattr__(self, item):
         if item == 'episodes':
             return
@@ -79,8 +141,31 @@ class WikipediaWrapper:
             return getattr(self.episodes, item)
 
     def get_size_if_missing_or_smaller(self, tatort_id: int, url: str) -> Optional[float]:
-        duration, size = self.filesize_estimator(url)
+        self._probe_inventory([tatort_id])
+        return self._size_if_missing_or_smaller(tatort_id, url, *self.filesize_estimator(url))
+
+    def get_sizes_if_missing_or_smaller(self, candidates: List[Tuple[int, str]]) -> List[Optional[float]]:
+        """
+        batch version of get_size_if_missing_or_smaller. The urls are probed concurrently.
+
+        :param candidates: list of (tatort_id, url)
+        :return: list of sizes in the same order as the candidates
+        """
+        estimates = self.filesize_estimator.estimate_many([url for _, url in candidates])
+        self._probe_inventory([tatort_id for tatort_id, _ in candidates], workers=self.filesize_estimator.workers)
+        return [self._size_if_missing_or_smaller(tatort_id, url, duration, size)
+                for (tatort_id, url), (duration, size) in zip(candidates, estimates)]
+
+    def _probe_inventory(self, tatort_ids: List[int], workers: int = 8):
+        if not self.offline:
+            self.inventory.probe_many(tatort_ids, workers=workers)
+            return
+        # ffprobe is not run offline, the unprobed local files are compared by their size
+        existing = [self.inventory.best(tatort_id) for tatort_id in set(tatort_ids)]
+        metrics.inc('inventory_unprobed', sum(entry is not None and not entry.probed for entry in existing))
 
+    def _size_if_missing_or_smaller(self, tatort_id: int, url: str, duration: Optional[float],
+                                    size: Optional[float]) -> Optional[float]:
         if size is None:
             return None
 
@@ -89,8 +174,17 @@ class WikipediaWrapper:
                         f' That is likely not a tatort url. Skipping: {url} ')
             return None
 
-        if tatort_id not in self.size_of_tatort or self.size_of_tatort[tatort_id] * 1.2 < size:
-            # missing or existing is significantly smaller
+        existing = self.inventory.best(tatort_id)
+        if existing is None:
+            # missing
+            return size
+        if existing.bit_rate and duration:
+            # both bit rates are known, which is a better quality measure than the size,
+            # as the size also depends on the length of the recording
+            if existing.bit_rate * 1.2 < size * 8 / duration:
+                return size
+        elif existing.size * 1.2 < size:
+            # existing is significantly smaller
             return size
         return None
 
@@ -114,97 +208,169 @@ class WikipediaWrapper:
         # there should be one and only closely matching title
         # distance
 
-        title_candidates = []
-        if title in self.title:
-            # title is an exact match
-            title_candidates.append(title)
-        else:
-            # we use fuzzy matching as a fallback
-            fuzzy_matches = sorted(process.extract(title, set(self.title)), key=itemgetter(1), reverse=True)
-            first_score = fuzzy_matches[0][1]
-            for i, (title_, score) in enumerate(fuzzy_matches):
-                if score > self.title_thresh or score == first_score:
-                    # take the first of the list and all others that have a higher score than the threshold
-                    # if two titles only differ by writings in brackets (like "Teil 1", "Teil 2") than the most likely one is used
-                    # this is a heuristic that will probably select the one with the correct version number
-                    # this heuristic is only applied when the scores differ!
-                    if i == 0 or \
-                            not (re.sub(" ?\([\d\D]*\)$", "", title_) ==
-                                 re.sub(" ?\([\d\D]*\)$", "", title_candidates[0])
-                                 and score != first_score):
-                        title_candidates.append(title_)
-                else:
-                    # the list is sorted, so we can break if the score no longer exceeds the threshold
-                    break
-
-        if len(title_candidates) == 1:
-            return [self.episodes[self.title == title_candidates[0]].index[0]]
-
-        title_candidates = Counter(pd.Series(title_candidates).str.replace(" ?\([\d\D]*\)$", "", regex=True))
-        titles_multiset = Counter(self.title.str.replace(" ?\([\d\D]*\)$", "", regex=True))
-        id_candidates = []
-        for title_ in title_candidates:
-            if titles_multiset.get(title_) == 1:
-                # if the title unique
-                id_candidates.append(self.episodes[self.title == title_].index[0])
-            else:
-                # try to use description to disambiguate
-                # if team in description of only one match -> surely correct
-                entries_with_title = (
-                    self.episodes[
-                        self.title.str.replace(" ?\([\d\D]*\)$", "", regex=True) == title_]
-                    .assign(recall=lambda df: df.meta_data.apply(
-                        lambda bag_of_words: len(bag_of_words & to_bag_of_words([descr])) / (len(bag_of_words) + 1e-10)
-                    )))
-
-                for id_, row in entries_with_title.iterrows():
-                    if row.recall * 100 > self.desc_thresh:
-                        id_candidates.append(id_)
-
-        return id_candidates
+        return self.matcher.predict(title, descr)
+
+    def predict_ids(self, df: pd.DataFrame) -> pd.Series:
+        """
+        batch version of try_predict_id for a whole mediathek table.
+
+        :param df: DataFrame with the columns title and description
+        :return: Series of id lists aligned with the index of df
+        """
+        start = time.perf_counter()
+
+        # exact matches of titles with a single episode are resolved with a join,
+        # titles of several episodes are disambiguated by the description like the fuzzy matches
+        unique_ids = pd.Series({title: ids[0] for title, ids in self.index.ids_by_title.items() if len(ids) == 1},
+                               name='tid', dtype=object)
+        exact = df[['title']].reset_index(drop=True).join(unique_ids, on='title').tid
+        predictions = [None if pd.isna(tid) else [tid] for tid in exact]
+
+        # the remaining rows are matched fuzzily, in parallel if there are many of them
+        residual = exact.index[exact.isna()]
+        with metrics.timer('match_fuzzy'):
+            fuzzy = self.matcher.predict_many(list(zip(df.title.iloc[residual], df.description.iloc[residual])),
+                                              workers=self.matching_workers, chunk_size=self.matching_chunk_size)
+        for i, ids in zip(residual, fuzzy):
+            predictions[i] = ids
+        metrics.inc('match_rows', len(df) - len(residual), kind='exact')
+        metrics.inc('match_rows', len(residual), kind='fuzzy')
+
+        duration = time.perf_counter() - start
+        logger.info(f'Predicted ids for {len(df)} entries ({len(residual)} fuzzy) in {duration:.2f}s'
+                    f' ({len(df) / max(duration, 1e-10):.0f} entries/s)')
+        return pd.Series(predictions, index=df.index, name='ids', dtype=object)
+
+    @property
+    def matcher(self) -> TitleMatcher:
+        # built once per title index
+        if self._matcher is None or self._matcher.index is not self.index:
+            self._matcher = TitleMatcher(self.index, self.title_thresh, self.desc_thresh)
+        return self._matcher
+
+
+class CityPredictor:
+    """
+    Predicts the city of a team by its best fuzzy match in teams.yaml ("?" and "??" mark uncertain predictions).
+    The predictions are memoized by the normalized team, and all unknown teams are scored at once.
+    """
+
+    def __init__(self):
+        teams_s = resources.read_text('tripper.resources', 'teams.yaml')
+        teams = {sort_and_simplify(team): city for team, city in yaml.safe_load(teams_s).items()}
+        self.keys = [choice_key(team) for team in teams]
+        self.cities = list(teams.values())
+        self.memo = dict()
+
+    def __call__(self, teams: pd.Series) -> pd.Series:
+        codes, uniques = pd.factorize(teams)
+        normalized = [sort_and_simplify(team) for team in uniques]
+        unknown = list({team for team in normalized if team not in self.memo})
+        if unknown:
+            # same scores as thefuzz.process.extractOne(team, teams)
+            scores = np.rint(process.cdist([query_key(team) for team in unknown], self.keys, scorer=fuzz.WRatio,
+                                           processor=None, dtype=np.float64, workers=-1))
+            for team, best, score in zip(unknown, scores.argmax(axis=1), scores.max(axis=1, initial=0)):
+                self.memo[team] = self.cities[best] + ('??' if score < 80 else '?' if score < 90 else '')
+        # missing teams have the code -1 and no city
+        return pd.Series([self.memo[team] for team in normalized], dtype=object).take(codes) \
+            .set_axis(teams.index).where(codes != -1)
+
+
+@lru_cache(maxsize=None)
+def city_predictor() -> CityPredictor:
+    return CityPredictor()
 
 
 class FilesizeEstimator:
     methods = ['ffmpeg', 'fallback']
 
-    def __init__(self):
+    def __init__(self, workers: int = 8, timeout: float = 120, cache_path: Optional[Path] = None,
+                 cache_ttl_days: float = 14, negative_ttl_days: float = 1, cache_max_entries: int = 20000,
+                 offline: bool = False):
+        """
+        :param workers: number of concurrent probes in estimate_many
+        :param timeout: timeout of a single probe in seconds
+        :param cache_path: sqlite file to persist the probe results. If None, nothing is cached
+        :param cache_ttl_days: how long successful probes are cached
+        :param negative_ttl_days: how long failed probes (geoblocked, 404) are cached
+        :param cache_max_entries: maximum number of cached urls
+        :param offline: never probe, urls that are not cached have an unknown size
+        """
         self.method = 'fallback' if which('ffprobe') is None else 'ffmpeg'
+        self.workers = workers
+        self.timeout = timeout
+        self.offline = offline
+        self.cache = None if cache_path is None else ProbeCache(cache_path, ttl_days=cache_ttl_days,
+                                                                  negative_ttl_days=negative_ttl_days,
+                                                                  max_entries=cache_max_entries)
         self.succesfull_methods = dict()
 
     def __call__(self, url, *args, **kwargs):
         return self.get_filesize(url)
 
+    def estimate_many(self, urls: List[str]) -> List[Tuple[Optional[float], Optional[float]]]:
+        """
+        probe all urls concurrently
+
+        :return: list of (duration, filesize) in the same order as the urls
+        """
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            return list(tqdm(executor.map(self.get_filesize, urls), total=len(urls), disable=None))
+
     def get_filesize(self, url) -> Tuple[Optional[float], Optional[float]]:
         """
 
         :param url:
         :return: duration if known, approximate filesize
         """
+        result = None if self.cache is None else self.cache.get(url)
+        if result is None and self.offline:
+            return None, None
+        if result is None:
+            with metrics.timer('probe'):
+                result = self.probe(url)
+            if result.failure is not None:
+                metrics.inc('probe_failures', kind=result.failure)
+            if self.cache is not None and result.failure != 'timeout':
+                # timeouts are likely temporary, hence they are not cached
+                self.cache.put(url, result)
+        return result.duration, result.size
+
+    def probe(self, url) -> ProbeResult:
         if self.method == 'ffmpeg':
             try:
                 result = (
                     check_output(
-                        ['ffprobe', url, '-show_entries', 'format=size,duration', '-v', 'quiet', '-of', 'csv=p=0'])
+                        ['ffprobe', url, '-show_entries', 'format=size,duration', '-v', 'quiet', '-of', 'csv=p=0'],
+                        timeout=self.timeout)
                     .decode('utf-8')
                 )
                 if not result:
                     logger.warning('ffprobe did not return filesize and duration estimate.'
                                    f' The url is likely geoblocked! Skipping: {url}')
+                    return ProbeResult(None, None, 'ffmpeg', 'geoblocked')
                 self.succesfull_methods['ffmpeg'] = True
-                return tuple([float(entry) for entry in result.split(',')])  # noqa
+                return ProbeResult(*[float(entry) for entry in result.split(',')], 'ffmpeg')  # noqa
             except (CalledProcessError, ValueError) as e:
                 logger.warning(f'Calling ffprobe failed. Maybe a 404 error. Skipping {url}')
-                return None, None
+                return ProbeResult(None, None, 'ffmpeg', 'not_found')
+            except TimeoutExpired:
+                logger.warning(f'Calling ffprobe timed out after {self.timeout}s. Skipping {url}')
+                return ProbeResult(None, None, 'ffmpeg', 'timeout')
 
         try:
-            size = urlopen(url).length
+            size = urlopen(url, timeout=self.timeout).length
             if size < 1000000:
-                direct_url = check_output(['youtube-dl', url, '-g']).decode('utf-8')
+                direct_url = check_output(['youtube-dl', url, '-g'], timeout=self.timeout).decode('utf-8')
                 if 'geoblock' in direct_url or 'geoprotect' in direct_url:
                     logger.info(f'The url is geoblocked. Skipping {url}')
-                    return None, None
-            return None, size
+                    return ProbeResult(None, None, 'fallback', 'geoblocked')
+            return ProbeResult(None, size, 'fallback')
         except HTTPError:
             logger.warning(f'Calling ffprobe failed. Maybe a 404 error. Skipping {url}')
 
-            return None, None
+            return ProbeResult(None, None, 'fallback', 'not_found')
+        except (TimeoutExpired, socket.timeout):
+            logger.warning(f'Probing timed out after {self.timeout}s. Skipping {url}')
+            return ProbeResult(None, None, 'fallback', 'timeout')
@@ -0,0 +1,89 @@
+import logging
+import sqlite3
+import time
+from pathlib import Path
+from threading import Lock
+from typing import NamedTuple, Optional
+
+from tripper.util.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+DAY = 24 * 60 * 60
+
+
+class ProbeResult(NamedTuple):
+    duration: Optional[float]
+    size: Optional[float]
+    method: str
+    failure: Optional[str] = None
+    timestamp: Optional[float] = None
+
+
+class ProbeCache:
+    """
+    Persistent cache of the FilesizeEstimator results, keyed by url.
+
+    The cache is a sqlite file, hence it can be shared between concurrent runs.
+    Failed probes (geoblocked, 404, ...) are only cached for the shorter negative_ttl.
+    """
+
+    def __init__(self, path: Path, ttl_days: float = 14, negative_ttl_days: float = 1, max_entries: int = 20000):
+        self.ttl = ttl_days * DAY
+        self.negative_ttl = negative_ttl_days * DAY
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = Lock()
+        self._con = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._con.execute('PRAGMA journal_mode=WAL')
+        self._con.execute('CREATE TABLE IF NOT EXISTS probes (url TEXT PRIMARY KEY, duration REAL, size REAL,'
+                          ' method TEXT, failure TEXT, timestamp REAL)')
+        self.evict()
+
+    def get(self, url: str, count: bool = True) -> Optional[ProbeResult]:
+        """
+        :param count: count the lookup in the hit/miss statistics
+        """
+        with self._lock:
+            row = self._con.execute('SELECT duration, size, method, failure, timestamp FROM probes WHERE url = ?',
+                                    (url,)).fetchone()
+            result = None if row is None else ProbeResult(*row)
+            if result is not None and result.timestamp < time.time() - (
+                    self.negative_ttl if result.failure else self.ttl):
+                result = None
+
+            if not count:
+                return result
+            if result is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        metrics.inc('probe_cache', result='miss' if result is None else 'hit')
+        return result
+
+    def put(self, url: str, result: ProbeResult):
+        with self._lock:
+            self._con.execute('INSERT OR REPLACE INTO probes VALUES (?, ?, ?, ?, ?, ?)',
+                              (url, result.duration, result.size, result.method, result.failure,
+                               result.timestamp or time.time()))
+
+    def evict(self):
+        """
+        remove expired entries and the oldest entries exceeding max_entries
+        """
+        now = time.time()
+        with self._lock:
+            self._con.execute('DELETE FROM probes WHERE timestamp < ? OR (failure IS NOT NULL AND timestamp < ?)',
+                              (now - self.ttl, now - self.negative_ttl))
+            self._con.execute('DELETE FROM probes WHERE url NOT IN'
+                              ' (SELECT url FROM probes ORDER BY timestamp DESC LIMIT ?)', (self.max_entries,))
+
+    def close(self):
+        with self._lock:
+            self._con.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._con.execute('SELECT COUNT(*) FROM probes').fetchone()[0]
@@ -0,0 +1,105 @@
+import json
+import logging
+import os
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+from typing import Iterable, Optional
+
+import pandas as pd
+
+from tripper.util.path import older
+
+try:
+    import pyarrow as pa
+    from pyarrow import feather
+except ImportError:  # pragma: no cover
+    pa = None
+
+logger = logging.getLogger(__name__)
+
+METADATA_KEY = b'tripper'
+
+
+class TableStore:
+    """
+    On-disk cache of a DataFrame.
+
+    If pyarrow is available, the table is stored as uncompressed feather file (typed, index preserving and
+    memory-mappable). Otherwise the fallback format (csv or pickle) is used.
+    The version is stored alongside the data. Caches written with another version are considered stale.
+    """
+
+    def __init__(self, path: Path, version: str, fallback: str = 'csv', set_columns: Iterable[str] = ()):
+        """
+        :param path: path of the cache without suffix
+        :param version: version of the data. Should be changed whenever the table is computed differently
+        :param fallback: 'csv' or 'pickle'
+        :param set_columns: columns containing sets, they are stored as lists in the columnar format
+        """
+        self.version = str(version)
+        self.set_columns = list(set_columns)
+        self.format = 'feather' if pa is not None else fallback
+        self.path = Path(path).with_suffix('.' + dict(feather='feather', csv='csv', pickle='pkl')[self.format])
+        self.meta_path = self.path.with_name(self.path.name + '.json')
+
+    def exists(self) -> bool:
+        return self.path.exists()
+
+    def read(self, max_age_days: Optional[float] = None) -> Optional[pd.DataFrame]:
+        """
+        :param max_age_days: if the cache is older, it is considered stale
+        :return: the stored table or None if the cache is missing or stale
+        """
+        if not self.path.exists() or (max_age_days is not None and older(self.path, days=max_age_days)):
+            return None
+
+        if self.format == 'feather':
+            table = feather.read_table(self.path, memory_map=True)
+            metadata = json.loads((table.schema.metadata or {}).get(METADATA_KEY, b'{}'))
+            df = None if metadata.get('version') != self.version else table.to_pandas()
+        else:
+            metadata = json.loads(self.meta_path.read_text()) if self.meta_path.exists() else dict()
+            if metadata.get('version') != self.version:
+                df = None
+            elif self.format == 'csv':
+                df = pd.read_csv(self.path, index_col=metadata.get('index'))
+            else:
+                df = pd.read_pickle(self.path)
+
+        if df is None:
+            logger.info(f'Ignoring {self.path}, it was written by another version ({metadata.get("version")})')
+            return None
+
+        for column in self.set_columns:
+            df[column] = df[column].map(set)
+        return df
+
+    def write(self, df: pd.DataFrame):
+        """
+        atomically replace the stored table
+        """
+        df = df.assign(**{column: df[column].map(sorted) for column in self.set_columns})
+        index = [name for name in df.index.names if name is not None] or None
+        metadata = dict(version=self.version, index=index)
+
+        if self.format == 'feather':
+            table = pa.Table.from_pandas(df)
+            table = table.replace_schema_metadata({**table.schema.metadata, METADATA_KEY: json.dumps(metadata)})
+            self._atomic(lambda path: feather.write_feather(table, path, compression='uncompressed'), self.path)
+        else:
+            if self.format == 'csv':
+                self._atomic(lambda path: df.to_csv(path, index=index is not None), self.path)
+            else:
+                self._atomic(df.to_pickle, self.path)
+            self._atomic(lambda path: Path(path).write_text(json.dumps(metadata)), self.meta_path)
+
+    @staticmethod
+    def _atomic(write, path: Path):
+        with NamedTemporaryFile(dir=path.parent, prefix=path.name, suffix='.tmp', delete=False) as f:
+            tmp = f.name
+        try:
+            write(tmp)
+            os.replace(tmp, path)
+        except BaseException:
+            Path(tmp).unlink(missing_ok=True)
+            raise
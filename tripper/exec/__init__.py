@@ -1,3 +1,4 @@
+from .daemon import Daemon
 from .runner import Runner
 
-__all__ = ['Runner']
+__all__ = ['Daemon', 'Runner']
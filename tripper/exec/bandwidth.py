@@ -0,0 +1,152 @@
+import logging
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+from threading import Lock
+from typing import Callable, List, NamedTuple, Optional
+
+from tripper.util.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+DAY_MINUTES = 24 * 60
+
+
+def parse_time(value: str) -> int:
+    """
+    :param value: HH:MM
+    :return: minutes since midnight
+    """
+    hours, minutes = map(int, str(value).split(':'))
+    return hours * 60 + minutes
+
+
+class Window(NamedTuple):
+    start: int
+    end: int
+    # bytes per second, None: unlimited, 0: paused
+    rate: Optional[float]
+
+    @property
+    def label(self) -> str:
+        return f'{self.start // 60:02d}:{self.start % 60:02d}-{self.end // 60:02d}:{self.end % 60:02d}'
+
+    def __contains__(self, minute: int) -> bool:
+        if self.start <= self.end:
+            return self.start <= minute < self.end
+        # the window wraps around midnight
+        return minute >= self.start or minute < self.end
+
+
+class BandwidthLimiter:
+    """
+    Token bucket shared by all concurrent downloads. The rate depends on the time of day (local time),
+    the first matching window applies, outside of all windows the default rate applies.
+    A rate of 0 pauses the downloads: they wait for the next window before they start (or, for the native
+    downloader, before the next chunk), the running transfers are finished without a limit.
+    """
+
+    def __init__(self, windows: List[Window], default_rate: Optional[float] = None, burst_seconds: float = 1,
+                 now: Callable[[], datetime] = datetime.now):
+        """
+        :param default_rate: bytes per second outside of the windows, None: unlimited
+        :param burst_seconds: the bucket holds the tokens of this many seconds
+        :param now: the local time
+        """
+        self.default = Window(0, DAY_MINUTES, default_rate)
+        self.windows = windows
+        self.burst_seconds = burst_seconds
+        self.now = now
+
+        self._lock = Lock()
+        self._rate = None
+        self._tokens = 0.
+        self._last = time.monotonic()
+        self._bytes = defaultdict(int)
+        self._active = dict()
+
+    @classmethod
+    def from_config(cls, conf: dict) -> Optional['BandwidthLimiter']:
+        """
+        :param conf: rate_mb (MB/s) and windows (start, end as HH:MM and rate_mb), an omitted rate is unlimited
+        :return: None if there is no limit at all
+        """
+        def rate(value):
+            return None if value is None else value * 1e6
+
+        windows = [Window(parse_time(window['start']), parse_time(window['end']), rate(window.get('rate_mb')))
+                   for window in conf.get('windows') or []]
+        if conf.get('rate_mb') is None and all(window.rate is None for window in windows):
+            return None
+        return cls(windows, rate(conf.get('rate_mb')), burst_seconds=conf.get('burst_seconds', 1))
+
+    def window(self, now: Optional[datetime] = None) -> Window:
+        now = now or self.now()
+        minute = now.hour * 60 + now.minute
+        return next((window for window in self.windows if minute in window), self.default)
+
+    def seconds_until_change(self, now: Optional[datetime] = None) -> float:
+        """
+        :return: seconds until the next start or end of a window
+        """
+        now = now or self.now()
+        midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        boundaries = [midnight + timedelta(minutes=minute + day * DAY_MINUTES)
+                      for window in self.windows for minute in (window.start, window.end) for day in (0, 1)]
+        return min([(b - now).total_seconds() for b in boundaries if b > now], default=float('inf'))
+
+    def wait_open(self):
+        """
+        block while the downloads are paused
+        """
+        logged = False
+        while self.window().rate == 0:
+            if not logged:
+                logger.info(f'Downloads are paused for {self.seconds_until_change() / 60:.0f} minutes')
+                logged = True
+            # the windows depend on the wall clock, hence sleep in steps (e.g. suspend, clock changes)
+            time.sleep(min(self.seconds_until_change() + .1, 60))
+
+    def acquire(self, n: int):
+        """
+        take n bytes out of the bucket, block until they are available.
+        Paused windows don't block, idle connections would only time out, see wait_open
+        """
+        window = self.window()
+        label = self._label(window)
+        with self._lock:
+            now = time.monotonic()
+            self._bytes[label] += n
+            # first and last transfer in the window
+            self._active[label] = (self._active.get(label, (now,))[0], now)
+            if not window.rate:
+                # unlimited, or paused while the transfer is finished
+                self._rate = window.rate
+                return
+            capacity = window.rate * self.burst_seconds
+            if self._rate != window.rate:
+                # a new window starts with a full bucket
+                self._rate, self._tokens = window.rate, capacity
+            else:
+                self._tokens = min(capacity, self._tokens + (now - self._last) * window.rate)
+            self._last = now
+            self._tokens -= n
+            delay = -self._tokens / window.rate
+        if delay > 0:
+            time.sleep(delay)
+
+    def _label(self, window: Window) -> str:
+        return 'default' if window is self.default else window.label
+
+    def report(self):
+        """
+        log and record the throughput per window since the last report
+        """
+        with self._lock:
+            for label, (start, end) in self._active.items():
+                throughput = self._bytes[label] / max(end - start, 1e-3)
+                metrics.inc('download_window_bytes', self._bytes[label], window=label)
+                metrics.set('download_window_throughput_bytes_per_second', throughput, window=label)
+                logger.info(f'Window {label}: {self._bytes[label] / 1e9:.2f} GB at {throughput / 1e6:.2f} MB/s')
+            self._bytes.clear()
+            self._active.clear()
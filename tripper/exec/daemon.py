@@ -0,0 +1,115 @@
+import logging
+import signal
+import time
+from pathlib import Path
+from threading import Event
+
+from tripper.exec.queue import DownloadQueue
+from tripper.exec.runner import Runner
+from tripper.util.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class Daemon:
+    """
+    Long running mode. The wikipedia data, the title index, the collection inventory and the probe cache
+    are kept in memory, every cycle only processes the mediathek entries that are new since the last cycle.
+    The downloads go through a persistent queue, so that pending and interrupted downloads survive restarts.
+    """
+
+    def __init__(self, runner: Runner, poll_interval_minutes: float = 30, wiki_interval_hours: float = 1,
+                 max_attempts: int = 3):
+        """
+        :param poll_interval_minutes: interval in which mediathekview is polled
+        :param wiki_interval_hours: interval in which the wikipedia list is checked for changes
+        :param max_attempts: failed downloads are retried in the following cycles until they failed this often
+        """
+        self.runner = runner
+        self.poll_interval = poll_interval_minutes * 60
+        self.wiki_interval = wiki_interval_hours * 60 * 60
+        self.max_attempts = max_attempts
+        self.stopped = Event()
+
+        cache_dir = Path(runner.conf['folders']['cache'])
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        self.queue = DownloadQueue(cache_dir / 'queue.sqlite')
+        self.model = None
+        self.tatorte = None
+        self._wiki_updated = None
+        # the jobs of the current cycle by destination
+        self._jobs = dict()
+        runner.postprocess_hooks.append(self._postprocessed)
+
+    def run(self):
+        # the running downloads are finished before stopping, the pending ones are skipped and remain in the queue
+        signal.signal(signal.SIGTERM, lambda *_: self.stop())
+        logger.info(f'Starting daemon, polling mediathekview every {self.poll_interval / 60:g} minutes')
+        while not self.stopped.is_set():
+            start = time.monotonic()
+            try:
+                self.cycle()
+            except Exception:  # noqa
+                # e.g. mediathekview is not reachable, the next cycle will try again
+                logger.exception('Cycle failed')
+            self.stopped.wait(max(0., self.poll_interval - (time.monotonic() - start)))
+        self.queue.close()
+        logger.info('Stopped daemon')
+
+    def stop(self):
+        self.stopped.set()
+
+    def cycle(self):
+        metrics.reset()
+        try:
+            with metrics.timer('cycle'):
+                self._cycle()
+        finally:
+            self.runner.report_metrics()
+
+    def _cycle(self):
+        if self.model is None:
+            # the daemon is always incremental, the first cycle continues from the last sync of any previous run
+            self.model, self.tatorte = self.runner.load(incremental=True)
+            self._wiki_updated = time.monotonic()
+        else:
+            update_wiki = time.monotonic() - self._wiki_updated > self.wiki_interval
+            with metrics.timer('stage', stage='wiki'):
+                try:
+                    self.model.refresh(episodes=update_wiki)
+                    if update_wiki:
+                        self._wiki_updated = time.monotonic()
+                except OSError as e:
+                    # connection problems (the requests exceptions are OSErrors as well)
+                    logger.warning(f'Could not update the wikipedia data, using the old data: {e!r}')
+            with metrics.timer('stage', stage='mediathek'):
+                self.tatorte.refresh()
+
+        jobs = self.runner.plan(self.model, self.tatorte.new)
+        for job in self.runner.deduplicate(jobs, self.queue.pending(self.max_attempts)):
+            self.queue.put(job)
+        jobs = self.queue.pending(self.max_attempts)
+        metrics.set('queue_length', len(jobs))
+        self._jobs = {job.dest: job for job in jobs}
+        self.runner.download_all(jobs, download=self._download)
+
+    def _download(self, url, dest: Path, overwrite=True, progress_hooks=None, size=None) -> bool:
+        if self.stopped.is_set():
+            # not a failed attempt, the job is downloaded after the restart
+            return False
+        success = False
+        try:
+            success = self.runner.download(url, dest, overwrite, progress_hooks, size)
+        finally:
+            if success:
+                self.queue.done(dest)
+            else:
+                self.queue.failed(dest)
+        return success
+
+    def _postprocessed(self, url: str, dest: Path, result: str):
+        # the job was already removed from the queue after its download
+        job = self._jobs.get(dest)
+        if result == 'quarantined' and job is not None:
+            logger.info(f'Queueing {dest} again, it failed the verification')
+            self.queue.retry(job)
@@ -0,0 +1,123 @@
+import logging
+import os
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import List, Optional, Sequence, Tuple
+
+from requests import RequestException
+
+from tripper.data_model.fingerprint import FingerprintIndex
+from tripper.exec.downloader import RangeDownloader
+from tripper.exec.queue import DownloadJob
+from tripper.util.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class Deduplicator:
+    """
+    Drops downloads whose content is already stored locally or queued under another url
+    (mediathekview lists the same movie for several channels).
+
+    Only downloads with the same exact size are fingerprinted, hence most downloads cost a single HEAD request.
+    """
+
+    def __init__(self, index: FingerprintIndex, link: bool = True, workers: int = 8):
+        """
+        :param link: hard-link identical local files to the destination of regular downloads instead of downloading
+        :param workers: number of concurrent HEAD and range requests
+        """
+        self.index = index
+        self.link = link
+        self.workers = workers
+
+    def filter(self, jobs: List[DownloadJob], pending: Sequence[DownloadJob] = ()) \
+            -> Tuple[List[DownloadJob], List[DownloadJob]]:
+        """
+        :param pending: the jobs that are already queued (e.g. in an earlier cycle of the daemon)
+        :return: the jobs that still have to be downloaded and the jobs that were hard-linked
+        """
+        if not jobs:
+            return [], []
+        self.index.refresh()
+        dests = {job.dest for job in jobs}
+        # a job that is planned again is not a duplicate of itself
+        pending = [job for job in pending if job.dest not in dests]
+        urls = list({job.url for job in [*jobs, *pending] if RangeDownloader.supports(job.url)})
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            sizes = dict(zip(urls, executor.map(self._size, urls)))
+            counts = Counter(sizes.values())
+            # only the contents that might have a duplicate are fingerprinted
+            candidates = [url for url, size in sizes.items()
+                          if size and (counts[size] > 1 or self.index.has_size(size))]
+            fingerprints = dict(zip(candidates, executor.map(self._fingerprint, candidates)))
+
+        downloads, linked = [], []
+        queued = dict()
+        for job in pending:
+            if fingerprints.get(job.url) is not None:
+                queued.setdefault(fingerprints[job.url], job)
+        # the regular downloads first, so that the check/error downloads are dropped in favor of them
+        for job in sorted(jobs, key=lambda job: job.priority):
+            fingerprint = fingerprints.get(job.url)
+            if fingerprint is None:
+                downloads.append(job)
+                continue
+
+            local = self.index.find_local(sizes[job.url], fingerprint)
+            if local is not None:
+                if Path(local) == Path(job.dest):
+                    logger.info(f'{job.dest} has already been downloaded')
+                    metrics.inc('dedup', result='skipped')
+                    continue
+                if not job.overwrite:
+                    logger.info(f'Skipping {job.dest}, it is identical to {local}')
+                    metrics.inc('dedup', result='skipped')
+                    continue
+                if self.link and self._link(local, job.dest):
+                    logger.info(f'Linked {job.dest} to the identical {local}')
+                    metrics.inc('dedup', result='linked')
+                    linked.append(job)
+                    continue
+
+            if fingerprint in queued and not job.overwrite:
+                logger.info(f'Skipping {job.dest}, it is identical to the download of {queued[fingerprint].dest}')
+                metrics.inc('dedup', result='skipped')
+                continue
+            queued.setdefault(fingerprint, job)
+            downloads.append(job)
+        return downloads, linked
+
+    def _size(self, url: str) -> Optional[int]:
+        try:
+            return self.index.remote_size(url)
+        except RequestException as e:
+            # the download itself will report the problem
+            logger.debug(f'Could not determine the size of {url}: {e!r}')
+            return None
+
+    def _fingerprint(self, url: str) -> Optional[str]:
+        try:
+            return self.index.remote_fingerprint(url)
+        except RequestException as e:
+            logger.debug(f'Could not fingerprint {url}: {e!r}')
+            return None
+
+    @staticmethod
+    def _link(src: Path, dest: Path) -> bool:
+        """
+        :return: False if hard links are not supported (e.g. different filesystems)
+        """
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        tmp = dest.with_name(dest.name + '.link')
+        try:
+            tmp.unlink(missing_ok=True)
+            os.link(src, tmp)
+            # replaces an older version like the download would
+            os.replace(tmp, dest)
+            return True
+        except OSError as e:
+            logger.warning(f'Could not link {dest} to {src}, downloading it instead: {e!r}')
+            tmp.unlink(missing_ok=True)
+            return False
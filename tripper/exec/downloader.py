@@ -0,0 +1,182 @@
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from threading import Lock
+from typing import Callable, List, NamedTuple, Optional, Tuple
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from tripper.exec.bandwidth import BandwidthLimiter
+from tripper.util.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class RangeDownloadError(Exception):
+    pass
+
+
+class RemoteFile(NamedTuple):
+    size: int
+    etag: Optional[str]
+
+
+class RangeDownloader:
+    """
+    Downloads progressive (direct) mp4 files with parallel range requests.
+
+    The output is preallocated as <dest>.part, the finished chunks are recorded in <dest>.part.json,
+    so that an interrupted download is resumed with the missing chunks only.
+    """
+
+    def __init__(self, connections: int = 4, chunk_size_mb: float = 16, timeout: float = 60, retries: int = 5,
+                 limiter: Optional[BandwidthLimiter] = None):
+        """
+        :param connections: number of parallel range requests per download
+        :param chunk_size_mb: size of a single range request
+        :param timeout: connect/read timeout of the requests
+        :param retries: retries per chunk
+        :param limiter: bandwidth limit shared with the other downloads, paused windows are waited for before each chunk
+        """
+        self.connections = connections
+        self.chunk_size = int(chunk_size_mb * 2 ** 20)
+        self.timeout = timeout
+        self.retries = retries
+        self.limiter = limiter
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=16, pool_maxsize=4 * connections,
+                              max_retries=Retry(total=retries, backoff_factor=1,
+                                                status_forcelist=[429, 500, 502, 503, 504]))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    @staticmethod
+    def supports(url: str) -> bool:
+        """
+        only direct mp4 urls are downloaded natively, everything else (HLS, DASH, websites) is left to youtube-dl
+        """
+        return urlparse(url).scheme in ('http', 'https') and urlparse(url).path.lower().endswith('.mp4')
+
+    @staticmethod
+    def part_files(dest: Path) -> Tuple[Path, Path]:
+        return dest.with_name(dest.name + '.part'), dest.with_name(dest.name + '.part.json')
+
+    def remote_file(self, url: str) -> Optional[RemoteFile]:
+        """
+        :return: the size and the ETag of the file if the server supports range requests
+        """
+        res = self.session.head(url, allow_redirects=True, timeout=self.timeout)
+        res.raise_for_status()
+        if res.headers.get('Accept-Ranges', '').lower() != 'bytes' or 'Content-Length' not in res.headers:
+            return None
+        return RemoteFile(int(res.headers['Content-Length']), res.headers.get('ETag'))
+
+    def download(self, url: str, dest: Path, expected_size: Optional[float] = None,
+                 progress_hooks: Optional[List[Callable]] = None) -> bool:
+        """
+        :param expected_size: the probed size. A file whose size differs more than 1% is not downloaded
+        :return: False if the url can't be downloaded with range requests
+        :raises RangeDownloadError: if the download failed, the partial download is kept to be resumed later
+        """
+        try:
+            remote = self.remote_file(url)
+        except requests.RequestException as e:
+            raise RangeDownloadError(f'Could not determine the size of {url}: {e!r}')
+        if remote is None:
+            return False
+        size = remote.size
+        if expected_size and abs(size - expected_size) > .01 * expected_size:
+            raise RangeDownloadError(f'Size of {url} ({size}) does not match the probed size ({expected_size:.0f})')
+
+        part, state_path = self.part_files(dest)
+        chunks = [(start, min(start + self.chunk_size, size) - 1) for start in range(0, size, self.chunk_size)]
+        state = dict(url=url, etag=remote.etag, size=size, chunk_size=self.chunk_size, done=[])
+        if part.exists() and state_path.exists():
+            previous = json.loads(state_path.read_text())
+            # the chunks of another url or of a changed file must not be mixed into the download
+            if all(previous.get(key) == state[key] for key in ('url', 'etag', 'size', 'chunk_size')):
+                state = previous
+                logger.info(f'Resuming {dest} ({len(state["done"])}/{len(chunks)} chunks done)')
+            else:
+                logger.info(f'Discarding the partial download of {dest}, the remote file changed')
+        if not state['done']:
+            self._preallocate(part, size)
+        state_path.write_text(json.dumps(state))
+
+        lock = Lock()
+        done = set(state['done'])
+        downloaded = [sum(chunks[i][1] - chunks[i][0] + 1 for i in done)]
+
+        fd = os.open(part, os.O_WRONLY)
+        try:
+            def fetch(i):
+                if self.limiter is not None:
+                    self.limiter.wait_open()
+                self._fetch_chunk(url, fd, *chunks[i])
+                with lock:
+                    done.add(i)
+                    downloaded[0] += chunks[i][1] - chunks[i][0] + 1
+                    state_path.write_text(json.dumps({**state, 'done': sorted(done)}))
+                    for hook in progress_hooks or []:
+                        hook(dict(status='downloading', downloaded_bytes=downloaded[0], total_bytes=size,
+                                  filename=str(dest)))
+
+            with ThreadPoolExecutor(max_workers=self.connections) as executor:
+                # consume the iterator to propagate exceptions
+                list(executor.map(fetch, [i for i in range(len(chunks)) if i not in done]))
+        except (requests.RequestException, OSError) as e:
+            raise RangeDownloadError(f'Failed to download {url}: {e!r}')
+        finally:
+            os.close(fd)
+
+        if len(done) != len(chunks) or part.stat().st_size != size:
+            part.unlink()
+            state_path.unlink()
+            raise RangeDownloadError(f'Download of {url} is incomplete, discarding {part}')
+
+        os.replace(part, dest)
+        state_path.unlink()
+        for hook in progress_hooks or []:
+            hook(dict(status='finished', downloaded_bytes=size, total_bytes=size, filename=str(dest)))
+        return True
+
+    @staticmethod
+    def _preallocate(part: Path, size: int):
+        with open(part, 'wb') as f:
+            try:
+                os.posix_fallocate(f.fileno(), 0, size)
+            except (AttributeError, OSError):
+                # not supported by the platform or filesystem
+                f.truncate(size)
+
+    def _fetch_chunk(self, url: str, fd: int, start: int, end: int):
+        for attempt in range(self.retries + 1):
+            try:
+                offset = start
+                with self.session.get(url, headers=dict(Range=f'bytes={start}-{end}'), stream=True,
+                                      timeout=self.timeout) as res:
+                    res.raise_for_status()
+                    if res.status_code != 206:
+                        raise RangeDownloadError(f'Server ignored the range request for {url}')
+                    for data in res.iter_content(2 ** 16):
+                        if self.limiter is not None:
+                            self.limiter.acquire(len(data))
+                        while data:
+                            written = os.pwrite(fd, data, offset)
+                            offset += written
+                            data = data[written:]
+                if offset != end + 1:
+                    raise requests.RequestException(f'Incomplete chunk {start}-{end}: received {offset - start} bytes')
+                return
+            except requests.RequestException:
+                if attempt == self.retries:
+                    raise
+                metrics.inc('download_retries')
+                time.sleep(2 ** attempt)
@@ -0,0 +1,200 @@
+import json
+import logging
+import os
+import shutil
+from pathlib import Path
+from queue import Queue
+from subprocess import run, TimeoutExpired
+from threading import Thread
+from typing import Callable, List, NamedTuple, Optional
+
+from tripper.data_model.inventory import CollectionInventory
+from tripper.data_model.probe_cache import ProbeCache
+from tripper.util.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class Verification(NamedTuple):
+    duration: Optional[float] = None
+    bit_rate: Optional[float] = None
+    height: Optional[int] = None
+    failure: Optional[str] = None
+
+
+class PostProcessor:
+    """
+    Verifies the finished downloads in the background, while the other downloads continue.
+
+    A download is checked with ffprobe (readable container, video stream, duration of the pre-download probe),
+    failed downloads are quarantined to the error folder. Good downloads are optionally remuxed losslessly
+    (moov atom at the start, the vtt subtitle embedded) and recorded in the inventory as verified.
+    """
+
+    def __init__(self, quarantine_dir: Path, inventory: Optional[CollectionInventory] = None,
+                 probe_cache: Optional[ProbeCache] = None, workers: int = 2, tolerance: float = .02,
+                 decode: bool = False, remux: bool = False, embed_subtitles: bool = True, timeout: float = 600,
+                 hooks: Optional[List[Callable[[str, Path, str], None]]] = None):
+        """
+        :param quarantine_dir: failed downloads are moved to this folder, downloads into it are not verified
+        :param probe_cache: the durations of the pre-download probes
+        :param workers: number of files processed concurrently
+        :param tolerance: allowed relative difference between the probed and the actual duration
+        :param decode: decode the whole file to find corrupt packets (slow)
+        :param remux: remux with faststart
+        :param embed_subtitles: embed the vtt subtitle when remuxing (ttml can't be read by ffmpeg)
+        :param timeout: timeout of a single ffprobe/ffmpeg call in seconds
+        :param hooks: called with the url, the destination and the result of every processed file
+        """
+        self.quarantine_dir = Path(quarantine_dir)
+        self.inventory = inventory
+        self.probe_cache = probe_cache
+        self.workers = workers
+        self.tolerance = tolerance
+        self.decode = decode
+        self.remux = remux
+        self.embed_subtitles = embed_subtitles
+        self.timeout = timeout
+        self.hooks = hooks if hooks is not None else []
+
+        self._queue = Queue()
+        self._threads: List[Thread] = []
+
+    @staticmethod
+    def available() -> bool:
+        return shutil.which('ffprobe') is not None and shutil.which('ffmpeg') is not None
+
+    def accepts(self, dest: Path) -> bool:
+        """
+        :return: False for the downloads into the quarantine folder, they are not verified
+        """
+        return Path(dest).parent != self.quarantine_dir
+
+    def submit(self, url: str, dest: Path):
+        if not self.accepts(dest):
+            return
+        if not self._threads:
+            self._threads = [Thread(target=self._work, daemon=True) for _ in range(self.workers)]
+            for thread in self._threads:
+                thread.start()
+        self._queue.put((url, Path(dest)))
+
+    def join(self):
+        """
+        block until all submitted files are processed
+        """
+        self._queue.join()
+
+    def _work(self):
+        while True:
+            url, dest = self._queue.get()
+            try:
+                with metrics.timer('postprocess'):
+                    result = self.process(url, dest)
+            except Exception as e:  # noqa
+                # a failed post-processing must not stop the worker, the download itself is kept
+                logger.error(f'Post-processing of {dest} failed: {e!r}')
+                result = 'error'
+            metrics.inc('postprocess', result=result)
+            try:
+                for hook in self.hooks:
+                    hook(url, dest, result)
+            except Exception as e:  # noqa
+                logger.error(f'Reporting the post-processing of {dest} failed: {e!r}')
+            finally:
+                self._queue.task_done()
+
+    def process(self, url: str, dest: Path) -> str:
+        """
+        :return: verified, remuxed or quarantined
+        """
+        probe = None if self.probe_cache is None else self.probe_cache.get(url, count=False)
+        verification = self.verify(dest, None if probe is None else probe.duration)
+        if verification.failure is not None:
+            self.quarantine(dest, verification.failure)
+            return 'quarantined'
+
+        result = 'verified'
+        if self.remux:
+            remuxed = self._remux(dest, verification)
+            if remuxed is not None:
+                verification, result = remuxed, 'remuxed'
+        if self.inventory is not None:
+            self.inventory.record(dest, verification.duration, verification.bit_rate, verification.height)
+        logger.info(f'Verified {dest}')
+        return result
+
+    def verify(self, path: Path, expected_duration: Optional[float] = None) -> Verification:
+        try:
+            proc = run(['ffprobe', '-v', 'error', '-of', 'json', '-show_entries',
+                        'format=duration,bit_rate:stream=codec_type,height', str(path)],
+                       capture_output=True, timeout=self.timeout)
+        except TimeoutExpired:
+            return Verification(failure='timeout')
+        try:
+            info = json.loads(proc.stdout)
+            format_ = info['format']
+            duration = float(format_['duration'])
+        except (ValueError, KeyError):
+            return Verification(failure='unreadable')
+        try:
+            bit_rate = float(format_['bit_rate'])
+        except (ValueError, KeyError):
+            # missing or N/A for some containers, the average bit rate is good enough
+            bit_rate = path.stat().st_size * 8 / duration if duration > 0 else None
+        if proc.returncode != 0:
+            return Verification(failure='corrupt')
+        if proc.stderr.strip():
+            # e.g. non-monotonic timestamps, the file is still playable
+            logger.warning(f'ffprobe reported problems with {path}: {proc.stderr.decode(errors="replace").strip()}')
+
+        videos = [stream for stream in info.get('streams', []) if stream.get('codec_type') == 'video']
+        if not videos:
+            return Verification(failure='no_video')
+        if expected_duration and abs(duration - expected_duration) > self.tolerance * expected_duration:
+            logger.warning(f'{path} is {duration:.0f}s long, but the probe reported {expected_duration:.0f}s')
+            return Verification(failure='duration')
+
+        if self.decode:
+            try:
+                proc = run(['ffmpeg', '-v', 'error', '-xerror', '-i', str(path), '-f', 'null', '-'],
+                           capture_output=True, timeout=self.timeout)
+            except TimeoutExpired:
+                return Verification(failure='timeout')
+            # -xerror stops at the first error, warnings are ignored
+            if proc.returncode != 0:
+                return Verification(failure='corrupt')
+        return Verification(duration, bit_rate, videos[0].get('height'))
+
+    def quarantine(self, path: Path, reason: str):
+        self.quarantine_dir.mkdir(parents=True, exist_ok=True)
+        logger.error(f'{path} failed the verification ({reason}), moving it to {self.quarantine_dir}')
+        # the subtitles are moved along with the movie
+        for file in [path] + [path.with_suffix(suffix) for suffix in ('.vtt', '.ttml')]:
+            if file.exists():
+                shutil.move(str(file), str(self.quarantine_dir / file.name))
+
+    def _remux(self, path: Path, verification: Verification) -> Optional[Verification]:
+        """
+        :return: the verification of the remuxed file, None if the original file was kept
+        """
+        subtitle = path.with_suffix('.vtt')
+        cmd = ['ffmpeg', '-v', 'error', '-y', '-i', str(path)]
+        if self.embed_subtitles and subtitle.exists():
+            cmd += ['-i', str(subtitle), '-map', '0', '-map', '1', '-c', 'copy', '-c:s', 'mov_text']
+        else:
+            cmd += ['-map', '0', '-c', 'copy']
+        # the temporary file must not look like a movie to the inventory scans
+        tmp = path.with_name(path.name + '.remux')
+        try:
+            proc = run(cmd + ['-movflags', '+faststart', '-f', 'mp4', str(tmp)], capture_output=True,
+                       timeout=self.timeout)
+            remuxed = self.verify(tmp, verification.duration) if proc.returncode == 0 else None
+        except TimeoutExpired:
+            remuxed = None
+        if remuxed is None or remuxed.failure is not None:
+            logger.warning(f'Remuxing {path} failed, keeping the original file')
+            tmp.unlink(missing_ok=True)
+            return None
+        os.replace(tmp, path)
+        return remuxed
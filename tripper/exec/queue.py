@@ -0,0 +1,88 @@
+import json
+import logging
+import sqlite3
+import time
+from pathlib import Path
+from threading import Lock
+from typing import List, NamedTuple, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class DownloadJob(NamedTuple):
+    url: str
+    dest: Path
+    priority: Tuple
+    overwrite: bool = True
+    size: Optional[float] = None
+    url_subtitle: Optional[str] = None
+    title: str = ''
+    attempts: int = 0
+
+
+class DownloadQueue:
+    """
+    Persistent queue of downloads, keyed by the destination file.
+
+    Jobs are only removed once they are downloaded, hence downloads that were pending or interrupted
+    when the process stopped are continued after a restart.
+    """
+
+    def __init__(self, path: Path):
+        self._lock = Lock()
+        self._con = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._con.execute('PRAGMA journal_mode=WAL')
+        self._con.execute('CREATE TABLE IF NOT EXISTS jobs (dest TEXT PRIMARY KEY, url TEXT, priority TEXT,'
+                          ' overwrite INTEGER, size REAL, url_subtitle TEXT, title TEXT, attempts INTEGER,'
+                          ' added REAL)')
+
+    def put(self, job: DownloadJob):
+        """
+        add the job. A queued job for the same destination is only replaced by a larger download
+        or, once it failed, by another url. The replacement starts with no failed attempts
+        """
+        with self._lock:
+            row = self._con.execute('SELECT url, size, attempts FROM jobs WHERE dest = ?',
+                                    (str(job.dest),)).fetchone()
+            if row is not None:
+                url, size, attempts = row
+                if (size or 0) >= (job.size or 0) and not (attempts and url != job.url):
+                    return
+            self._con.execute('INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                              (str(job.dest), job.url, json.dumps(job.priority), job.overwrite, job.size,
+                               job.url_subtitle, job.title, 0, time.time()))
+
+    def retry(self, job: DownloadJob):
+        """
+        queue a downloaded job again (e.g. the file failed the verification), this counts as a failed attempt
+        """
+        with self._lock:
+            self._con.execute('INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                              (str(job.dest), job.url, json.dumps(job.priority), job.overwrite, job.size,
+                               job.url_subtitle, job.title, job.attempts + 1, time.time()))
+
+    def pending(self, max_attempts: int = 3) -> List[DownloadJob]:
+        """
+        :return: all jobs that failed less than max_attempts times, oldest first
+        """
+        with self._lock:
+            rows = self._con.execute('SELECT url, dest, priority, overwrite, size, url_subtitle, title, attempts'
+                                     ' FROM jobs WHERE attempts < ? ORDER BY added', (max_attempts,)).fetchall()
+        return [DownloadJob(url, Path(dest), tuple(json.loads(priority)), bool(overwrite), *rest)
+                for url, dest, priority, overwrite, *rest in rows]
+
+    def done(self, dest: Path):
+        with self._lock:
+            self._con.execute('DELETE FROM jobs WHERE dest = ?', (str(dest),))
+
+    def failed(self, dest: Path):
+        with self._lock:
+            self._con.execute('UPDATE jobs SET attempts = attempts + 1 WHERE dest = ?', (str(dest),))
+
+    def close(self):
+        with self._lock:
+            self._con.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._con.execute('SELECT COUNT(*) FROM jobs').fetchone()[0]
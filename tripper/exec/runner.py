@@ -1,14 +1,18 @@
 import logging
 import re
-from operator import itemgetter
+import time
+from functools import cached_property
 from pathlib import Path
+from typing import Callable, List, Optional, Sequence, Tuple
 
-from requests import get, RequestException
+import pandas as pd
 from tqdm import tqdm
-from youtube_dl import YoutubeDL
-from youtube_dl.utils import DownloadError
 
 from tripper.data_model import MediathekWrapper, WikipediaWrapper
+from tripper.exec.queue import DownloadJob
+from tripper.exec.scheduler import DownloadScheduler
+from tripper.util.http import session
+from tripper.util.metrics import metrics
 
 logger = logging.getLogger(__name__)
 
@@ -20,70 +24,308 @@ class Runner:
 
         del conf['general']
         self.conf = conf
+        self.model = None
+        # called with the url, the destination and the result of every post-processed download
+        self.postprocess_hooks: List[Callable[[str, Path, str], None]] = []
+
+    @cached_property
+    def downloader(self):
+        download = self.conf.get('download', dict())
+        if download.get('engine', 'native') != 'native':
+            return None
+        # direct mp4 urls are downloaded natively, youtube-dl remains the fallback for everything else.
+        # requests is only imported if something is downloaded
+        from tripper.exec.downloader import RangeDownloader
+        return RangeDownloader(connections=download.get('connections', 4),
+                               chunk_size_mb=download.get('chunk_size_mb', 16), limiter=self.limiter)
+
+    @cached_property
+    def limiter(self):
+        from tripper.exec.bandwidth import BandwidthLimiter
+        return BandwidthLimiter.from_config(self.conf.get('bandwidth', dict()))
+
+    @cached_property
+    def postprocessor(self):
+        postprocess = self.conf.get('postprocess', dict())
+        from tripper.exec.postprocess import PostProcessor
+        if not postprocess.get('enabled', True) or not PostProcessor.available():
+            return None
+        folders = self.conf['folders']
+        model = self.model
+        return PostProcessor(Path(folders['tatort_store_prefix']) / folders['error'],
+                             inventory=None if model is None else model.inventory,
+                             probe_cache=None if model is None else model.filesize_estimator.cache,
+                             workers=postprocess.get('workers', 2), tolerance=postprocess.get('tolerance', .02),
+                             decode=postprocess.get('decode', False), remux=postprocess.get('remux', False),
+                             embed_subtitles=postprocess.get('embed_subtitles', True), hooks=self.postprocess_hooks)
+
+    @cached_property
+    def deduplicator(self):
+        dedup = self.conf.get('dedup', dict())
+        if not dedup.get('enabled', True):
+            return None
+        from tripper.data_model.fingerprint import FingerprintIndex
+        from tripper.exec.dedup import Deduplicator
+        folders = self.conf['folders']
+        store = Path(folders['tatort_store_prefix'])
+        index = FingerprintIndex(Path(folders['cache']) / 'fingerprints.sqlite',
+                                 [store / folders[folder] for folder in ('final', 'output', 'error')],
+                                 sample_bytes=int(dedup.get('sample_kb', 1024) * 2 ** 10))
+        return Deduplicator(index, link=dedup.get('link', True), workers=dedup.get('workers', 8))
 
     def run(self):
+        metrics.reset()
+        try:
+            with metrics.timer('run'):
+                self._run()
+        finally:
+            self.report_metrics()
+
+    def report_metrics(self):
+        logger.info('Metrics of this run:\n' + metrics.summary())
+        conf = self.conf.get('metrics', dict())
+        metrics.write(json_path=conf.get('json'), prometheus_path=conf.get('prometheus'))
+
+    def _run(self):
+        model, tatorte = self.load()
+        # in the incremental mode only the entries that are new since the last sync are processed
+        jobs = self.deduplicate(self.plan(model, tatorte.new))
+        self.download_all(jobs)
+
+        cache = model.filesize_estimator.cache
+        if cache is not None:
+            logger.info(f'Probe cache: {cache.hits} hits, {cache.misses} misses')
+
+    def check(self) -> List[DownloadJob]:
+        """
+        report what a run would download, only using the cached data (no network requests)
+        """
+        metrics.reset()
+        model, tatorte = self.load(offline=True)
+        jobs = sorted(self.plan(model, tatorte.new), key=lambda job: job.priority)
+        for job in jobs:
+            size = f' ({job.size / 1e9:.2f} GB)' if job.size else ''
+            logger.info(f'would create {job.dest} from {job.url}{size}')
+
+        n_checks = sum(job.priority[0] == 1 for job in jobs)
+        unknown = int(metrics.get('probe_cache', result='miss'))
+        unprobed = int(metrics.get('inventory_unprobed'))
+        logger.info(f'A run would download {len(jobs) - n_checks} movies and {n_checks} check/error movies.'
+                    + (f' The size of {unknown} matched movies is unknown, as they were not probed yet.'
+                       if unknown else '')
+                    + (f' {unprobed} local files were not probed yet and are compared by their size.'
+                       if unprobed else ''))
+        return jobs
+
+    def load(self, incremental: Optional[bool] = None, offline: bool = False) \
+            -> Tuple[WikipediaWrapper, MediathekWrapper]:
+        """
+        :param incremental: overwrites the incremental setting of the mediathek config
+        :param offline: only use the cached data, regardless of their age
+        """
         folders = self.conf['folders']
         Path(folders['cache']).mkdir(parents=True, exist_ok=True)
-        pred_thresholds = self.conf['pred_thresholds']
         mediathek = self.conf['mediathek']
 
         logger.info('Retrieving mediathek and wikipedia data')
-        processed = dict()
-        model = WikipediaWrapper(cache_dir=folders['cache'], final_tatortdirs=[folders['final'], folders['output']],
-                                 pred_thresholds=pred_thresholds)
-        tatorte = MediathekWrapper(cache_dir=folders['cache'], mediathek_query_size=mediathek['query_size'])
+        with metrics.timer('stage', stage='wiki'):
+            model = WikipediaWrapper(cache_dir=folders['cache'],
+                                     final_tatortdirs=[folders['final'], folders['output']],
+                                     pred_thresholds=self.conf['pred_thresholds'], probe=self.conf.get('probe'),
+                                     offline=offline, matching=self.conf.get('matching'))
+        with metrics.timer('stage', stage='mediathek'):
+            tatorte = MediathekWrapper(cache_dir=folders['cache'], mediathek_query_size=mediathek['query_size'],
+                                       incremental=mediathek.get('incremental', False)
+                                       if incremental is None else incremental,
+                                       page_size=mediathek.get('page_size', 250), offline=offline,
+                                       rules=mediathek.get('rules'), full_sync_days=mediathek.get('full_sync_days', 7))
+        # the post-processing records the verified downloads in the inventory of the model
+        self.model = model
+        return model, tatorte
+
+    def plan(self, model: WikipediaWrapper, entries: pd.DataFrame) -> List[DownloadJob]:
+        """
+        match the mediathek entries and select the new or higher quality versions
 
+        :return: the downloads (priority (0, -tid)) and the check/error downloads (priority (1, i))
+        """
+        folders = self.conf['folders']
         logger.info('Preprocessing all Tatort entries and filtering for new or higher quality versions.')
+        processed = dict()
         downloads = dict()
         check_downloads = []
-        for tatort in tqdm(tatorte, total=len(tatorte)):
-            ids = model.try_predict_id(tatort.title, tatort.description)
-
+        matches = []
+        with metrics.timer('stage', stage='matching'):
+            predictions = model.predict_ids(entries)
+        for (_, tatort), ids in tqdm(zip(entries.iterrows(), predictions), total=len(entries)):
             if len(ids) == 1:
-                # download file to output folder
-                tid = ids[0]
-                new_size = model.get_size_if_missing_or_smaller(tid, tatort.url)
-                if new_size is not None and new_size > processed.get(tid, 0):
-                    processed[tid] = new_size
-                    downloads[tid] = (tatort, model.filename(tid))
+                matches.append((ids[0], tatort))
             else:
                 check_downloads.append((tatort.url, f'{ids} {tatort.title} – {tatort.description[:100]}.mp4'))
 
-        if downloads:
-            logger.info(f'Start downloading {len(downloads)} movies')
-            target = Path(folders['tatort_store_prefix']) / folders['output']
-            for _, (tatort, dest) in tqdm(sorted(downloads.items(), key=itemgetter(0), reverse=True), disable=None):
-                self.download(tatort.url, target / dest.replace('/', '⧸'))
+        logger.info(f'Estimating the file sizes of {len(matches)} matched movies')
+        with metrics.timer('stage', stage='probing'):
+            new_sizes = model.get_sizes_if_missing_or_smaller([(tid, tatort.url) for tid, tatort in matches])
+        for (tid, tatort), new_size in zip(matches, new_sizes):
+            # download file to output folder
+            if new_size is not None and new_size > processed.get(tid, 0):
+                processed[tid] = new_size
+                downloads[tid] = (tatort, model.filename(tid))
+
+        jobs = []
+        target = Path(folders['tatort_store_prefix']) / folders['output']
+        for tid, (tatort, dest) in downloads.items():
+            # newest episodes first
+            jobs.append(DownloadJob(tatort.url, target / dest.replace('/', '⧸'), priority=(0, -tid),
+                                    size=processed[tid], url_subtitle=tatort.url_subtitle, title=tatort.title))
+
+        target = Path(folders['tatort_store_prefix']) / folders['error']
+        for i, (url, dest) in enumerate(check_downloads):
+            # the check/error movies are only started after all regular downloads
+            jobs.append(DownloadJob(url, target / dest.replace('/', '⧸'), priority=(1, i), overwrite=False))
+        return jobs
+
+    def deduplicate(self, jobs: List[DownloadJob], pending: Sequence[DownloadJob] = ()) -> List[DownloadJob]:
+        """
+        drop the downloads whose content is already stored or queued under another url,
+        identical local files are hard-linked to the destination of regular downloads
+
+        :param pending: the jobs that are already queued
+        :return: the jobs that still have to be downloaded
+        """
+        # the fingerprint index is not even opened if there is nothing to download
+        if not jobs or self.deduplicator is None or self.dry_run:  # noqa
+            return jobs
+        logger.info(f'Checking {len(jobs)} downloads for identical contents')
+        with metrics.timer('stage', stage='dedup'):
+            jobs, linked = self.deduplicator.filter(jobs, pending)
+        for job in linked:
+            if job.url_subtitle:
+                self.download_subtitle(job, job.dest)
+        return jobs
+
+    def download_all(self, jobs: List[DownloadJob], download: Optional[Callable] = None):
+        """
+        :param download: replaces self.download, same signature
+        """
+        conf = self.conf.get('download', dict())
+        scheduler = DownloadScheduler(download or self.download, workers=conf.get('workers', 3),
+                                      per_host=conf.get('per_host', 2))
+        for job in jobs:
+            scheduler.submit(job.url, job.dest, priority=job.priority, overwrite=job.overwrite, size=job.size)
+            if job.url_subtitle:
+                scheduler.submit_side(self.download_subtitle, job, job.dest)
+
+        if len(scheduler):
+            n_checks = sum(job.priority[0] == 1 for job in jobs)
+            logger.info(f'Start downloading {len(jobs) - n_checks} movies and {n_checks} check/error movies')
+            # created before the concurrent downloads submit their files
+            postprocessor = self.postprocessor
+            start = time.perf_counter()
+            with metrics.timer('stage', stage='downloads'):
+                scheduler.run()
+            if self.limiter is not None:
+                self.limiter.report()
+            metrics.set('download_throughput_bytes_per_second',
+                        metrics.get('download_bytes') / (time.perf_counter() - start))
+            if postprocessor is not None:
+                # most files were already processed during the downloads
+                with metrics.timer('stage', stage='postprocess'):
+                    postprocessor.join()
+
+    def download_subtitle(self, tatort, dest: Path):
+        from requests import RequestException
+
+        try:
+            with metrics.timer('subtitle'):
+                r = session().get(tatort.url_subtitle, timeout=60)
+            mapping = [('.*text/xml.*', 'ttml'), ('.*', 'vtt')]
+            suffix = [suff for pat, suff in mapping if re.match(pat, r.headers['content-type'])][0]
+            dest.parent.mkdir(parents=True, exist_ok=True)
+            with open(dest.with_name(dest.name[:-3] + suffix), 'w') as f:
+                print(r.text, file=f)
+            metrics.inc('subtitles', result='ok')
+        except RequestException:
+            logger.warning(f'Was not able to download subtitle for {tatort.title}')
+            metrics.inc('subtitles', result='failed')
+
+    def download(self, url, dest: Path, overwrite=True, progress_hooks=None, size=None) -> bool:
+        """
+        :return: False if the download failed
+        """
+        from tripper.exec.downloader import RangeDownloader, RangeDownloadError
 
-                try:
-                    # subtitle
-                    r = get(tatort.url_subtitle)
-                    mapping = [('.*text/xml.*', 'ttml'), ('.*', 'vtt')]
-                    suffix = [suff for pat, suff in mapping if re.match(pat, r.headers['content-type'])][0]
-                    with open(target / (dest.replace('/', '⧸')[:-3] + suffix), 'w') as f:
-                        print(r.text, file=f)
-                except RequestException:
-                    logger.warning(f'Was not able to download subtitle for {tatort.title}')
-
-        if check_downloads:
-            logger.info(f'Start downloading {len(check_downloads)} check/error movies')
-            target = Path(folders['tatort_store_prefix']) / folders['error']
-            for url, dest in tqdm(check_downloads):
-                self.download(url, target / dest.replace('/', '⧸'), overwrite=False)
-
-    def download(self, url, dest: Path, overwrite=True):
         dest.parent.mkdir(parents=True, exist_ok=True)
         if self.dry_run:  # noqa
             logger.info(f'would create {dest} from {url}')
+            return True
         else:
             if overwrite:
                 # remove old finished files (happens if we download, because of higher quality)
                 # fortunately this will not remove partial files, which youtube-dl will continue!
                 dest.unlink(missing_ok=True)
+            elif dest.exists():
+                logger.info(f'{dest} has already been downloaded')
+                return True
+
+            start = time.perf_counter()
+            if self.downloader is not None and self.downloader.supports(url):
+                try:
+                    if self.downloader.download(url, dest, expected_size=size, progress_hooks=progress_hooks):
+                        self._record_download(url, dest, 'native', start)
+                        return True
+                except RangeDownloadError as e:
+                    logger.error(f'Failed to download {dest}: {e}')
+                    metrics.inc('download_failures', engine='native')
+                    return False
+            part, state = RangeDownloader.part_files(dest)
+            if state.exists():
+                # partial files of the native downloader are preallocated, youtube-dl must not continue them
+                part.unlink(missing_ok=True)
+                state.unlink()
+
+            # youtube-dl takes a third of a second to import, hence it is only loaded if it is needed
+            from youtube_dl import YoutubeDL
+            from youtube_dl.utils import DownloadError
+
             ydl_opts = dict(outtmpl=str(dest), retries=5,
                             external_downloader_args=['-hide_banner', '-loglevel', 'panic'])
+            if self.limiter is not None:
+                self.limiter.wait_open()
+                # youtube-dl calls the hooks after every block, blocking in the hook throttles the download.
+                # ffmpeg reports no progress, hence HLS is downloaded natively. Streams that youtube-dl can't
+                # download natively (e.g. encrypted other than AES-128) are left to ffmpeg and are not throttled
+                ydl_opts.update(hls_prefer_native=True)
+                progress_hooks = [self._throttle_hook()] + list(progress_hooks or [])
+            if progress_hooks:
+                # the progress is reported by the caller, as the output of concurrent downloads would interleave
+                ydl_opts.update(progress_hooks=progress_hooks, noprogress=True)
             try:
                 with YoutubeDL(ydl_opts) as ydl:
                     ydl.download([url])
+                self._record_download(url, dest, 'youtube-dl', start)
+                return True
             except DownloadError:
                 logger.error(f'Failed to download {dest}. Skipping {url}')
+                metrics.inc('download_failures', engine='youtube-dl')
+                return False
+
+    def _throttle_hook(self) -> Callable:
+        downloaded = dict()
+
+        def hook(status: dict):
+            if status.get('status') == 'downloading' and 'downloaded_bytes' in status:
+                # the count restarts for every file (e.g. separate video and audio formats)
+                previous = downloaded.get(status.get('filename'), 0)
+                downloaded[status.get('filename')] = status['downloaded_bytes']
+                self.limiter.acquire(max(0, status['downloaded_bytes'] - previous))
+
+        return hook
+
+    def _record_download(self, url, dest: Path, engine: str, start: float):
+        metrics.observe('download', time.perf_counter() - start, engine=engine)
+        if dest.exists():
+            metrics.inc('download_bytes', dest.stat().st_size)
+            if self.postprocessor is not None:
+                # verified in the background, while the next download starts
+                self.postprocessor.submit(url, dest)
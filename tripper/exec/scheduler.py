@@ -0,0 +1,117 @@
+import logging
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait
+from pathlib import Path
+from threading import Condition, Thread
+from typing import Callable, List, NamedTuple, Optional, Tuple
+from urllib.parse import urlparse
+
+from tqdm import tqdm
+
+logger = logging.getLogger(__name__)
+
+
+class Job(NamedTuple):
+    priority: Tuple
+    seq: int
+    url: str
+    dest: Path
+    overwrite: bool
+    size: Optional[float] = None
+
+    @property
+    def host(self):
+        return urlparse(self.url).netloc
+
+
+class DownloadScheduler:
+    """
+    Runs several downloads concurrently. Jobs are started in the order of their priority (lowest first),
+    but a job is only started if its host has less than per_host active downloads.
+    Side tasks (like subtitles) run in a separate small pool, overlapping with the downloads.
+    """
+
+    def __init__(self, download: Callable, workers: int = 3, per_host: int = 2, side_workers: int = 2):
+        """
+        :param download: callable(url, dest, overwrite, progress_hooks, size)
+        :param workers: maximum number of concurrent downloads
+        :param per_host: maximum number of concurrent downloads per host
+        :param side_workers: number of workers for the side tasks
+        """
+        self.download = download
+        self.workers = workers
+        self.per_host = per_host
+        self.side_workers = side_workers
+
+        self._jobs: List[Job] = []
+        self._side_tasks = []
+        self._active_hosts = Counter()
+        self._downloaded_bytes = dict()
+        self._cond = Condition()
+        self._progress: Optional[tqdm] = None
+
+    def __len__(self):
+        return len(self._jobs)
+
+    def submit(self, url: str, dest: Path, priority: Tuple = (0,), overwrite: bool = True,
+               size: Optional[float] = None):
+        """
+        :param size: expected size of the download, if known
+        """
+        self._jobs.append(Job(tuple(priority), len(self._jobs), url, dest, overwrite, size))
+
+    def submit_side(self, fn: Callable, *args):
+        self._side_tasks.append((fn, args))
+
+    def run(self):
+        """
+        block until all jobs and side tasks are processed
+        """
+        self._progress = tqdm(total=len(self._jobs), unit='movie', disable=None)
+        with ThreadPoolExecutor(max_workers=self.side_workers) as side_executor:
+            side_futures = [side_executor.submit(fn, *args) for fn, args in self._side_tasks]
+            self._side_tasks = []
+
+            threads = [Thread(target=self._work, daemon=True) for _ in range(min(self.workers, len(self._jobs)))]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            for future in wait(side_futures).done:
+                if future.exception() is not None:
+                    logger.error(f'Side task failed: {future.exception()!r}')
+        self._progress.close()
+
+    def _next_job(self) -> Optional[Job]:
+        with self._cond:
+            while self._jobs:
+                for job in sorted(self._jobs):
+                    if self._active_hosts[job.host] < self.per_host:
+                        self._jobs.remove(job)
+                        self._active_hosts[job.host] += 1
+                        return job
+                # all pending jobs are blocked by their host limit
+                self._cond.wait()
+            return None
+
+    def _work(self):
+        while (job := self._next_job()) is not None:
+            try:
+                self.download(job.url, job.dest, job.overwrite, [self._progress_hook(job)], job.size)
+            except Exception as e:
+                logger.error(f'Failed to download {job.dest}: {e!r}. Skipping {job.url}')
+            finally:
+                with self._cond:
+                    self._active_hosts[job.host] -= 1
+                    self._progress.update()
+                    self._cond.notify_all()
+
+    def _progress_hook(self, job: Job):
+        def hook(status: dict):
+            if 'downloaded_bytes' in status:
+                with self._cond:
+                    self._downloaded_bytes[job.seq] = status['downloaded_bytes']
+                    self._progress.set_postfix(GB=f'{sum(self._downloaded_bytes.values()) / 1e9:.2f}', refresh=False)
+
+        return hook
@@ -0,0 +1,126 @@
+import gzip
+import hashlib
+import json
+import logging
+import os
+import time
+from functools import lru_cache
+from pathlib import Path
+from typing import Iterator, Optional
+
+from tripper.util.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1 << 16
+
+
+@lru_cache(maxsize=None)
+def session(retries: int = 3, backoff_factor: float = .5):
+    """
+    :return: shared session with connection pooling. Failed requests (including the idempotent POST queries
+             of mediathekview) are retried with exponential backoff
+    """
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    session_ = requests.Session()
+    adapter = HTTPAdapter(pool_connections=8, pool_maxsize=16,
+                          max_retries=Retry(total=retries, backoff_factor=backoff_factor,
+                                            status_forcelist=[429, 500, 502, 503, 504],
+                                            allowed_methods=None))
+    session_.mount('http://', adapter)
+    session_.mount('https://', adapter)
+    return session_
+
+
+class CachedResponse:
+    def __init__(self, changed: bool, chunks: Iterator[bytes]):
+        """
+        :param changed: False if the cached body is still valid (the server answered 304 Not Modified)
+        """
+        self.changed = changed
+        self._chunks = chunks
+
+    def iter_content(self) -> Iterator[bytes]:
+        """
+        the body can only be iterated once
+        """
+        return self._chunks
+
+    @property
+    def content(self) -> bytes:
+        return b''.join(self._chunks)
+
+
+class HttpCache:
+    """
+    Stores raw responses gzip compressed (<name>.gz) together with their ETag/Last-Modified validators (<name>.json)
+    and sends conditional requests, so that unchanged resources are neither downloaded nor parsed again.
+    """
+
+    def __init__(self, cache_dir: Path, timeout: float = 60):
+        self.cache_dir = Path(cache_dir)
+        self.timeout = timeout
+
+    def paths(self, name: str):
+        return self.cache_dir / f'{name}.gz', self.cache_dir / f'{name}.json'
+
+    def request(self, name: str, url: str, method: str = 'GET', data: Optional[str] = None,
+                headers: Optional[dict] = None) -> CachedResponse:
+        """
+        :param name: name of the cache entry
+        :param data: request body, the validators are only sent if the body did not change either
+        """
+        body_path, meta_path = self.paths(name)
+        key = hashlib.sha1(f'{method} {url} {data}'.encode()).hexdigest()
+        meta = json.loads(meta_path.read_text()) if meta_path.exists() and body_path.exists() else dict()
+
+        headers = dict(headers or dict())
+        if meta.get('key') == key:
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+
+        with metrics.timer('http', entry=name):
+            res = session().request(method, url, data=data, headers=headers, stream=True, timeout=self.timeout)
+        if res.status_code == 304:
+            res.close()
+            logger.info(f'{url} did not change since {meta["last_modified"] or time.ctime(meta["fetched"])}')
+            metrics.inc('http_cache', entry=name, result='not_modified')
+            return CachedResponse(False, self._read(body_path))
+        res.raise_for_status()
+        validated = 'If-None-Match' in headers or 'If-Modified-Since' in headers
+        metrics.inc('http_cache', entry=name, result='modified' if validated else 'miss')
+        meta = dict(key=key, etag=res.headers.get('ETag'), last_modified=res.headers.get('Last-Modified'),
+                    fetched=time.time())
+        return CachedResponse(True, self._store(res, body_path, meta_path, meta))
+
+    @staticmethod
+    def _read(body_path: Path) -> Iterator[bytes]:
+        with gzip.open(body_path, 'rb') as f:
+            while chunk := f.read(CHUNK_SIZE):
+                yield chunk
+
+    @staticmethod
+    def _store(res, body_path: Path, meta_path: Path, meta: dict) -> Iterator[bytes]:
+        """
+        stream the body to the caller and into the cache at the same time,
+        the cache entry is only replaced once the body was read completely
+        """
+        body_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = body_path.with_name(body_path.name + '.tmp')
+        complete = False
+        try:
+            with res, gzip.open(tmp, 'wb', compresslevel=6) as f:
+                for chunk in res.iter_content(chunk_size=CHUNK_SIZE):
+                    f.write(chunk)
+                    yield chunk
+            os.replace(tmp, body_path)
+            meta_path.write_text(json.dumps(meta))
+            complete = True
+        finally:
+            if not complete:
+                tmp.unlink(missing_ok=True)
@@ -0,0 +1,133 @@
+import json
+import os
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+from threading import Lock
+from typing import Dict, Tuple
+
+BUCKETS = (.001, .005, .01, .05, .1, .5, 1, 5, 10, 30, 60, 300, 900, 3600, float('inf'))
+
+Key = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+
+def _key(name: str, labels: dict) -> Key:
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _labels(labels, **extra) -> str:
+    items = list(labels) + list(extra.items())
+    return '{' + ','.join(f'{k}="{v}"' for k, v in items) + '}' if items else ''
+
+
+class Metrics:
+    """
+    Minimal registry of counters, gauges and timers (histograms).
+    The module level instance `metrics` is shared by all components of a run.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counters: Dict[Key, float] = defaultdict(float)
+            self.gauges: Dict[Key, float] = dict()
+            self.histograms: Dict[Key, list] = dict()
+            self.sums: Dict[Key, float] = defaultdict(float)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        with self._lock:
+            self.counters[_key(name, labels)] += value
+
+    def set(self, name: str, value: float, **labels):
+        with self._lock:
+            self.gauges[_key(name, labels)] = value
+
+    def get(self, name: str, **labels) -> float:
+        """
+        :return: the value of the counter or gauge, 0 if it was not recorded
+        """
+        key = _key(name, labels)
+        with self._lock:
+            return self.counters.get(key, self.gauges.get(key, 0))
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            if key not in self.histograms:
+                self.histograms[key] = [0] * len(BUCKETS)
+            self.histograms[key][bisect_left(BUCKETS, seconds)] += 1
+            self.sums[key] += seconds
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def to_dict(self) -> dict:
+        def fmt(key):
+            name, labels = key
+            return name + _labels(labels)
+
+        with self._lock:
+            return dict(
+                counters={fmt(k): v for k, v in self.counters.items()},
+                gauges={fmt(k): v for k, v in self.gauges.items()},
+                timers={fmt(k): dict(count=sum(buckets), sum=self.sums[k],
+                                     buckets={str(le): c for le, c in zip(BUCKETS, buckets)})
+                        for k, buckets in self.histograms.items()})
+
+    def to_prometheus(self, prefix='tripper') -> str:
+        lines = []
+        with self._lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append(f'{prefix}_{name}_total{_labels(labels)} {value}')
+            for (name, labels), value in sorted(self.gauges.items()):
+                lines.append(f'{prefix}_{name}{_labels(labels)} {value}')
+            for (name, labels), buckets in sorted(self.histograms.items()):
+                cumulative = 0
+                for le, count in zip(BUCKETS, buckets):
+                    cumulative += count
+                    le = '+Inf' if le == float('inf') else le
+                    lines.append(f'{prefix}_{name}_seconds_bucket{_labels(labels, le=le)} {cumulative}')
+                lines.append(f'{prefix}_{name}_seconds_sum{_labels(labels)} {self.sums[(name, labels)]}')
+                lines.append(f'{prefix}_{name}_seconds_count{_labels(labels)} {cumulative}')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self) -> str:
+        """
+        :return: human readable table of all metrics
+        """
+        rows = []
+        with self._lock:
+            for (name, labels), buckets in sorted(self.histograms.items()):
+                count, total = sum(buckets), self.sums[(name, labels)]
+                rows.append((name + _labels(labels), f'{count}x', f'{total:.2f}s', f'{total / count:.3f}s avg'))
+            for (name, labels), value in sorted({**self.counters, **self.gauges}.items()):
+                rows.append((name + _labels(labels), f'{value:g}', '', ''))
+        width = max([len(r[0]) for r in rows], default=0)
+        return '\n'.join(f'{r[0]:<{width}}  {r[1]:>10} {r[2]:>10} {r[3]:>14}'.rstrip() for r in rows)
+
+    def write(self, json_path=None, prometheus_path=None):
+        """
+        write the metrics atomically (the prometheus textfile collector might read the file at any time)
+        """
+        for path, content in [(json_path, lambda: json.dumps(self.to_dict(), indent=2)),
+                              (prometheus_path, self.to_prometheus)]:
+            if path is None:
+                continue
+            path = Path(path)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_name(path.name + '.tmp')
+            tmp.write_text(content())
+            os.replace(tmp, path)
+
+
+metrics = Metrics()
@@ -0,0 +1,55 @@
+import codecs
+import json
+import re
+from typing import Iterable, Iterator
+
+_SEPARATOR = re.compile(r'[\s,]*')
+
+
+def iter_json_array(chunks: Iterable[bytes], key: str, compact_after: int = 1 << 16) -> Iterator:
+    """
+    Incrementally decode the items of the first json array stored under key (e.g. {"result": {"results": [...]}}),
+    without holding the whole document in memory. The items have to be objects or arrays.
+
+    :param chunks: the utf-8 encoded document, e.g. response.iter_content()
+    :param compact_after: the decoded part of the buffer is dropped once it is larger than this
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    chunks = (utf8.decode(chunk) for chunk in chunks)
+    start = re.compile(r'"%s"\s*:\s*\[' % re.escape(key))
+
+    buffer = ''
+    for chunk in chunks:
+        buffer += chunk
+        match = start.search(buffer)
+        if match is not None:
+            buffer = buffer[match.end():]
+            break
+        # the key might be split between two chunks
+        buffer = buffer[-len(key) - 16:]
+    else:
+        return
+
+    pos = 0
+    while True:
+        pos = _SEPARATOR.match(buffer, pos).end()
+        if pos < len(buffer) and buffer[pos] == ']':
+            # consume the rest of the document, so that the source is read completely (e.g. the HttpCache)
+            for _ in chunks:
+                pass
+            return
+        try:
+            item, pos = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            # the item is incomplete, read the next chunk
+            chunk = next(chunks, None)
+            if chunk is None:
+                raise
+            buffer = buffer[pos:] + chunk
+            pos = 0
+            continue
+        yield item
+        if pos > compact_after:
+            buffer = buffer[pos:]
+            pos = 0